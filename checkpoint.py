@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+
+__author__ = 'Azatris'
+
+import numpy as np
+
+import layer
+from network import Network
+
+log = logging.root
+
+
+class Checkpointer(object):
+    """ Keeps the latest snapshot of a MAC training state in a directory:
+    the network and the auxiliary coordinates as .npy files, the rest of
+    the state as JSON. The training data (first and last aux) never
+    changes, so it is written once per run next to the snapshots.
+    A snapshot is copied in memory and then written on a background
+    thread, one at a time, so that training can carry on meanwhile. An
+    exception writing it is raised by the next wait or save. Memory-mapped
+    aux are not copied but written straight from their files, before save
+    returns, as copying them would need them all in memory at once. """
+
+    LATEST = 'latest'
+
+    def __init__(self, directory, data_written=False):
+        """ :param data_written: whether the training data in the directory
+            is already that of this run, e.g. when resuming """
+
+        self.directory = directory
+        self.data_written = data_written
+        self.writer = None
+        self.error = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def save(self, network, aux, state):
+        """ Snapshots the network, the aux and a JSON serializable state
+        which has to contain the iteration as 'step'. """
+
+        self.wait()
+        layers = [(type(L).__name__, L.weights.copy(), L.biases.copy())
+                  for L in network.layers]
+        hidden_aux = [a if isinstance(a, np.memmap) else np.array(a, copy=True)
+                      for a in aux[1:-1]]
+        data = None if self.data_written else (aux[0], aux[-1])
+        self.data_written = True
+
+        args = (layers, hidden_aux, data, dict(state))
+        if any(isinstance(a, np.memmap) for a in hidden_aux):
+            self._write(*args)
+            return
+        self.writer = threading.Thread(
+            target=self._write_in_background, args=args
+        )
+        self.writer.start()
+
+    def wait(self):
+        """ Blocks until the snapshot being written, if any, is on disk.
+        Raises the exception writing it failed with, if any. """
+
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        if self.error is not None:
+            error_type, error, trace = self.error
+            self.error = None
+            raise error_type, error, trace
+
+    def _write_in_background(self, *args):
+        # Kept for wait to raise, as the thread would only print it.
+        try:
+            self._write(*args)
+        except Exception:
+            self.error = sys.exc_info()
+
+    def _write(self, layers, hidden_aux, data, state):
+        if data is not None:
+            for name, array in zip(['feats', 'labels'], data):
+                self._save_array(os.path.join(self.directory, name), array)
+
+        snapshot = 'snapshot-%d' % state['step']
+        path = os.path.join(self.directory, snapshot)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        for idx, (_, weights, biases) in enumerate(layers):
+            np.save(os.path.join(path, 'weights_%d.npy' % idx), weights)
+            np.save(os.path.join(path, 'biases_%d.npy' % idx), biases)
+        for idx, a in enumerate(hidden_aux, 1):
+            np.save(os.path.join(path, 'aux_%d.npy' % idx), a)
+        state['layers'] = [type_name for type_name, _, _ in layers]
+        with open(os.path.join(path, 'state.json'), 'w') as f:
+            json.dump(state, f)
+
+        # Point at the new snapshot atomically, only then drop the old one.
+        previous = self.latest(self.directory)
+        latest = os.path.join(self.directory, self.LATEST)
+        with open(latest + '.tmp', 'w') as f:
+            f.write(snapshot)
+        os.rename(latest + '.tmp', latest)
+        if previous not in (None, snapshot):
+            shutil.rmtree(os.path.join(self.directory, previous))
+        log.debug("Checkpoint written to %s.", path)
+
+    @staticmethod
+    def _save_array(filename, array):
+        with open(filename + '.npy.tmp', 'wb') as f:
+            np.save(f, array)
+        os.rename(filename + '.npy.tmp', filename + '.npy')
+
+    @staticmethod
+    def latest(directory):
+        """ Returns the name of the latest snapshot, None if there is
+        none. """
+
+        try:
+            with open(os.path.join(directory, Checkpointer.LATEST)) as f:
+                return f.read().strip()
+        except IOError:
+            return None
+
+    @staticmethod
+    def load(directory):
+        """ Returns the network, aux and state of the latest snapshot. The
+        aux are memory-mapped, the hidden ones copy-on-write, so training
+        on them leaves the snapshot intact. """
+
+        snapshot = Checkpointer.latest(directory)
+        if snapshot is None:
+            raise IOError("No checkpoint in %s" % directory)
+        path = os.path.join(directory, snapshot)
+        with open(os.path.join(path, 'state.json')) as f:
+            state = json.load(f)
+
+        layers = [
+            getattr(layer, type_name)(
+                weights=np.load(os.path.join(path, 'weights_%d.npy' % idx)),
+                biases=np.load(os.path.join(path, 'biases_%d.npy' % idx))
+            )
+            for idx, type_name in enumerate(state['layers'])
+        ]
+        aux = [np.load(os.path.join(directory, 'feats.npy'), mmap_mode='r')]
+        aux.extend(
+            np.load(os.path.join(path, 'aux_%d.npy' % idx), mmap_mode='c')
+            for idx in xrange(1, len(layers))
+        )
+        aux.append(np.load(os.path.join(directory, 'labels.npy'),
+                           mmap_mode='r'))
+        log.info("Loaded checkpoint %s.", path)
+        return Network(layers=layers), aux, state
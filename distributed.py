@@ -0,0 +1,706 @@
+import itertools
+import logging
+import multiprocessing
+import time
+
+__author__ = 'Azatris'
+
+import numpy as np
+
+import parallel
+from pipeline import Minibatches
+from network import param_count
+from trainer import Mac, Sgd, SgdWorkspace, WStepProblem
+
+log = logging.root
+
+
+def _mac_worker(connection, network, shard, a_step_chunk_size, solver):
+    """ Serves a shard of the training data and its aux to a DistributedMac
+    coordinator. Every command is answered with its result and the time
+    spent computing it. """
+
+    started = time.time()
+    feats, labels = shard
+    mac = Mac(network, shard, None,
+              a_step_mode='batched', a_step_chunk_size=a_step_chunk_size,
+              solver=solver)
+    mac.w_step_options['disp'] = False
+    mac.initialise_aux(feats, labels)
+    connection.send((len(feats), time.time() - started))
+
+    while True:
+        command, payload = connection.recv()
+        started = time.time()
+        result = None
+        if command == 'stop':
+            break
+        elif command == 'set_params':
+            network.params[...] = payload
+        elif command == 'w_step':
+            mac.w_step_options.update(payload)
+            mac.w_step()
+            result = network.params
+        elif command == 'refine':
+            blocks, options = payload
+            result = [
+                WStepProblem(
+                    mac.augmented[idx_layer],
+                    mac.aux[idx_layer+1][:, start:stop],
+                    top=top, direct=False
+                ).minimize(params, options, mac.solver)[0]
+                for idx_layer, start, stop, params, top in blocks
+            ]
+        elif command == 'a_step':
+            mac.mu, options = payload
+            mac.a_step_options.update(options)
+            mac.a_step()
+            result = mac.penalised_error
+        connection.send((result, time.time() - started))
+    connection.close()
+
+
+class DistributedMac(Mac):
+    """ MAC with the training data and its aux sharded over a number of
+    local worker processes, talking to this process through pipes. Every
+    worker does the A-step of its own shard. For the W-step the layers are
+    either split into submodels (blocks of output units) which circulate
+    through all workers, each refining them on its shard, or every worker
+    solves the whole W-step on its shard and the results are averaged.
+    The shards' parts of the penalised objective are summed up after the
+    A-step. Wall and compute times of every step are kept in timings. """
+
+    W_STEP_EXCHANGES = ('circulate', 'average')
+
+    def __init__(self, network, training_data, validation_data, workers=2,
+                 w_step_exchange='circulate', epochs=1, circulate_maxiter=3,
+                 units_per_task=50, a_step_chunk_size=1000,
+                 solver='Newton-CG', schedule=None):
+        """ :param workers: number of worker processes (shards)
+        :param w_step_exchange: 'circulate' or 'average'
+        :param epochs: times every submodel goes round all the workers
+        :param circulate_maxiter: Newton-CG iterations a worker spends on
+            a submodel before passing it on """
+
+        if w_step_exchange not in self.W_STEP_EXCHANGES:
+            raise ValueError("Unknown W-step exchange: %s" % w_step_exchange)
+
+        super(DistributedMac, self).__init__(
+            network, training_data, validation_data, a_step_mode='batched',
+            units_per_task=units_per_task, a_step_chunk_size=a_step_chunk_size,
+            solver=solver, schedule=schedule
+        )
+        self.workers = workers
+        self.w_step_exchange = w_step_exchange
+        self.epochs = epochs
+        self.circulate_maxiter = circulate_maxiter
+        self.connections = []
+        self.worker_processes = []
+        self.shard_sizes = []
+        self.timings = {'w_step': [], 'a_step': []}
+
+    def initialise_aux(self, feats, labels):
+        """ Shards the data over freshly started workers, which initialise
+        the aux of their shards. """
+
+        log.debug("Starting %d MAC workers...", self.workers)
+        for shard in np.array_split(np.arange(len(feats)), self.workers):
+            shard = slice(shard[0], shard[-1] + 1)
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=parallel.run_worker,
+                args=(_mac_worker, worker_connection, self.network,
+                      (feats[shard], labels[shard]), self.a_step_chunk_size,
+                      self.solver)
+            )
+            process.daemon = True
+            process.start()
+            self.connections.append(connection)
+            self.worker_processes.append(process)
+        try:
+            self.shard_sizes = \
+                [parallel.receive(c)[0] for c in self.connections]
+        except parallel.WorkerError:
+            self.terminate()
+            raise
+        log.debug("aux initialized on shards of %s.", self.shard_sizes)
+
+    def release(self):
+        """ Stops the workers. """
+
+        for connection in self.connections:
+            connection.send(('stop', None))
+            connection.close()
+        for process in self.worker_processes:
+            process.join()
+        self.connections = []
+        self.worker_processes = []
+
+    def terminate(self):
+        """ Stops the workers right away, e.g. once one of them failed. """
+
+        for connection in self.connections:
+            connection.close()
+        parallel.terminate(self.worker_processes)
+        self.connections = []
+        self.worker_processes = []
+
+    def exchange(self, command, payloads):
+        """ Sends every worker its payload of a command and waits for all of
+        them. Returns their results and the longest compute time. If a
+        worker failed, stops them all and raises its WorkerError. """
+
+        try:
+            for connection, payload in zip(self.connections, payloads):
+                parallel.send(connection, (command, payload))
+            results, compute_times = zip(*[
+                parallel.receive(c) for c in self.connections
+            ])
+        except parallel.WorkerError:
+            self.terminate()
+            raise
+        return list(results), max(compute_times)
+
+    def broadcast_params(self):
+        return self.exchange('set_params',
+                             [self.network.params] * self.workers)[1]
+
+    def w_step(self):
+        started = time.time()
+        if self.w_step_exchange == 'average':
+            results, compute_time = self.exchange(
+                'w_step', [self.w_step_options] * self.workers
+            )
+            weights = np.asarray(self.shard_sizes, dtype=float)
+            weights /= np.sum(weights)
+            self.network.params[...] = sum(
+                w * result for w, result in zip(weights, results)
+            )
+        else:
+            compute_time = self.circulate()
+        compute_time += self.broadcast_params()
+
+        self.timings['w_step'].append((time.time() - started, compute_time))
+        log.info("W-step took %.2fs, %.2fs of which computing.",
+                 *self.timings['w_step'][-1])
+
+    def circulate(self):
+        """ Passes every submodel through all the workers, each of them
+        holding a different set of submodels at a time. Returns the time
+        spent computing. """
+
+        top = len(self.network.layers) - 1
+        blocks = []
+        for idx_layer in xrange(len(self.network.layers)):
+            params = self.network.layer_params(idx_layer)
+            for start in xrange(0, params.shape[1], self.units_per_task):
+                stop = min(start + self.units_per_task, params.shape[1])
+                blocks.append([idx_layer, start, stop, params[:, start:stop],
+                               idx_layer == top])
+
+        options = dict(self.w_step_options, disp=False, maxiter=min(
+            self.w_step_options.get('maxiter', self.circulate_maxiter),
+            self.circulate_maxiter
+        ))
+        compute_time = 0.0
+        for r in xrange(self.epochs * self.workers):
+            held = [
+                [b for idx_block, b in enumerate(blocks)
+                 if idx_block % self.workers == (p + r) % self.workers]
+                for p in xrange(self.workers)
+            ]
+            results, round_time = self.exchange(
+                'refine', [(h, options) for h in held]
+            )
+            compute_time += round_time
+            for h, result in zip(held, results):
+                for block, params in zip(h, result):
+                    block[3] = params
+
+        for idx_layer in xrange(len(self.network.layers)):
+            self.network.layer_params(idx_layer)[...] = np.concatenate(
+                [b[3] for b in blocks if b[0] == idx_layer], axis=1
+            )
+        return compute_time
+
+    def a_step(self):
+        started = time.time()
+        penalties, compute_time = self.exchange(
+            'a_step', [(self.mu, self.a_step_options)] * self.workers
+        )
+        self.penalised_error = sum(penalties)
+        self.timings['a_step'].append((time.time() - started, compute_time))
+        log.info("A-step took %.2fs, %.2fs of which computing.",
+                 *self.timings['a_step'][-1])
+
+
+def _sgd_worker(connection, network, shard, minibatch_size, momentum, cost,
+                seed):
+    """ Trains a network whose params are in shared memory on a shard of
+    the training data, without any locking, an epoch per learning rate it
+    receives. Answers with the costs of its minibatches. """
+
+    np.random.seed(seed)
+    workspace = SgdWorkspace(network, minibatch_size, cost)
+    minibatches = Minibatches(shard, minibatch_size)
+    while True:
+        learning_rate = connection.recv()
+        if learning_rate is None:
+            break
+        workspace.reset_velocities()
+        connection.send([
+            workspace.step(xs, ys, learning_rate, momentum)
+            for xs, ys in minibatches
+        ])
+    connection.close()
+
+
+class HogwildSgd(Sgd):
+    """ SGD with the params of the network in shared memory, updated at
+    once by a number of local worker processes without any locking
+    (Hogwild!), each on its own shard of the training data and with its
+    own momentum. Evaluation and scheduling stay in this process and are
+    done between epochs, while the workers wait. """
+
+    def __init__(self, workers=2):
+        """ :param workers: number of worker processes (shards) """
+
+        super(HogwildSgd, self).__init__()
+        self.workers = workers
+        self.connections = []
+        self.worker_processes = []
+
+    def start(self, network, training_data, minibatch_size, momentum):
+        """ Moves the params of the network into shared memory and starts
+        the workers, which share them through fork. """
+
+        self.network = network
+        self.training_data = training_data
+        self.minibatch_size = minibatch_size
+        self.momentum = momentum
+        network.bind_params(parallel.shared_copy(network.params))
+
+        feats, labels = training_data
+        log.debug("Starting %d SGD workers...", self.workers)
+        shards = np.array_split(np.arange(len(feats)), self.workers)
+        for seed, shard in enumerate(shards, np.random.randint(2**16)):
+            shard = slice(shard[0], shard[-1] + 1)
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=parallel.run_worker,
+                args=(_sgd_worker, worker_connection, network,
+                      (feats[shard], labels[shard]), minibatch_size,
+                      momentum, self.cost, seed)
+            )
+            process.daemon = True
+            process.start()
+            self.connections.append(connection)
+            self.worker_processes.append(process)
+
+    def train_epoch(self, learning_rate):
+        costs = []
+        try:
+            for connection in self.connections:
+                parallel.send(connection, learning_rate)
+            for connection in self.connections:
+                costs.extend(parallel.receive(connection))
+        except parallel.WorkerError:
+            self.terminate()
+            raise
+        return costs
+
+    def terminate(self):
+        """ Stops the workers right away, e.g. once one of them failed. """
+
+        for connection in self.connections:
+            connection.close()
+        parallel.terminate(self.worker_processes)
+        self.connections = []
+        self.worker_processes = []
+
+    def finish(self):
+        """ Stops the workers and moves the params back into private
+        memory. """
+
+        for connection in self.connections:
+            connection.send(None)
+            connection.close()
+        for process in self.worker_processes:
+            process.join()
+        self.connections = []
+        self.worker_processes = []
+        self.network.bind_params()
+
+
+def _sync_sgd_worker(connection, network, training_data, minibatch_size,
+                     momentum, cost, worker, slots, total):
+    """ Keeps a replica of the network and computes gradients on its part of
+    every global minibatch into its own slot of the shared slots. Once all
+    the workers have, each of them sums its chunk of the slots into the
+    shared total (reduce-scatter) and then all of them apply the total to
+    their replicas (all-gather). The coordinator's messages act as the
+    barriers in between. """
+
+    feats, labels = training_data
+    workers = len(slots)
+    workspace = SgdWorkspace(network, minibatch_size, cost, slots[worker])
+    chunk = np.array_split(np.arange(total.size), workers)[worker]
+    chunk = slice(chunk[0], chunk[-1] + 1) if len(chunk) else slice(0, 0)
+    compute_time = 0.0
+    communication_time = 0.0
+
+    while True:
+        command, payload = connection.recv()
+        if command == 'stop':
+            break
+        elif command == 'sync':
+            params = network.params if worker == 0 else None
+            connection.send(((compute_time, communication_time), params))
+        elif command == 'epoch':
+            learning_rate, permutation = payload
+            workspace.reset_velocities()
+            compute_time = 0.0
+            communication_time = 0.0
+            for start in xrange(0, len(permutation), minibatch_size):
+                rows = permutation[start:start + minibatch_size]
+                own = np.array_split(rows, workers)[worker]
+
+                started = time.time()
+                scalar_cost = 0.0
+                if len(own):
+                    scalar_cost = workspace.gradients(feats[own], labels[own])
+                else:
+                    slots[worker].fill(0.0)
+                compute_time += time.time() - started
+                connection.send(scalar_cost * len(own))
+
+                connection.recv()
+                started = time.time()
+                np.sum(slots[:, chunk], axis=0, out=total[chunk])
+                communication_time += time.time() - started
+                connection.send(None)
+
+                connection.recv()
+                started = time.time()
+                workspace.nabla[...] = total
+                communication_time += time.time() - started
+                started = time.time()
+                workspace.update(learning_rate, momentum, len(rows))
+                compute_time += time.time() - started
+    connection.close()
+
+
+class SyncSgd(Sgd):
+    """ Synchronous data-parallel SGD. Every global minibatch is split over
+    a number of local worker processes, each keeping a replica of the
+    network. Their gradients are all-reduced in shared memory and every
+    replica does the identical momentum update, so they never diverge.
+    Per epoch, the wall time, the time the slowest worker spent computing
+    and the time it spent communicating are kept in timings, the bytes
+    sent and received by all the workers together in communicated. """
+
+    def __init__(self, workers=2):
+        """ :param workers: number of worker processes (replicas) """
+
+        super(SyncSgd, self).__init__()
+        self.workers = workers
+        self.connections = []
+        self.worker_processes = []
+        self.timings = []
+        self.communicated = []
+        self.slots = None
+
+    def start(self, network, training_data, minibatch_size, momentum):
+        """ Starts the workers with replicas of the network, minibatch_size
+        being that of the global minibatch. """
+
+        self.network = network
+        self.training_data = training_data
+        self.minibatch_size = minibatch_size
+        self.momentum = momentum
+
+        size = param_count(network)
+        self.slots = slots = \
+            parallel.shared_array((self.workers, size), network.dtype)
+        total = parallel.shared_array(size, network.dtype)
+        log.debug("Starting %d SGD replicas...", self.workers)
+        for worker in xrange(self.workers):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=parallel.run_worker,
+                args=(_sync_sgd_worker, worker_connection, network, training_data,
+                      minibatch_size, momentum, self.cost, worker,
+                      slots, total)
+            )
+            process.daemon = True
+            process.start()
+            self.connections.append(connection)
+            self.worker_processes.append(process)
+
+    def barrier(self):
+        """ Waits for every worker, returning what they sent. If a worker
+        failed, stops them all and raises its WorkerError. """
+
+        try:
+            return [parallel.receive(c) for c in self.connections]
+        except parallel.WorkerError:
+            self.terminate()
+            raise
+
+    def broadcast(self, message):
+        try:
+            for connection in self.connections:
+                parallel.send(connection, message)
+        except parallel.WorkerError:
+            self.terminate()
+            raise
+
+    def terminate(self):
+        """ Stops the workers right away, e.g. once one of them failed. """
+
+        for connection in self.connections:
+            connection.close()
+        parallel.terminate(self.worker_processes)
+        self.connections = []
+        self.worker_processes = []
+
+    def train_epoch(self, learning_rate):
+        started = time.time()
+        permutation = np.random.permutation(len(self.training_data[0]))
+        self.broadcast(('epoch', (learning_rate, permutation)))
+        costs = []
+        steps = 0
+        for start in xrange(0, len(permutation), self.minibatch_size):
+            steps += 1
+            rows = min(self.minibatch_size, len(permutation) - start)
+            costs.append(sum(self.barrier()) / rows)
+            self.broadcast('reduce')
+            self.barrier()
+            self.broadcast('apply')
+
+        # Every replica is the same, take the params of the first one.
+        self.broadcast(('sync', None))
+        results = self.barrier()
+        self.network.params[...] = results[0][1]
+
+        compute_time, communication_time = \
+            np.max([timing for timing, _ in results], axis=0)
+        self.timings.append(
+            (time.time() - started, compute_time, communication_time)
+        )
+        # Every worker writes its gradients and reads the total every step.
+        self.communicated.append(2 * steps * self.slots.nbytes)
+        log.info("Epoch took %.2fs, %.2fs of which computing and %.2fs "
+                 "communicating %.1f MB.",
+                 *(self.timings[-1] + (self.communicated[-1] / 2.0**20,)))
+        return costs
+
+    def finish(self):
+        """ Stops the workers. """
+
+        self.broadcast(('stop', None))
+        for connection in self.connections:
+            connection.close()
+        for process in self.worker_processes:
+            process.join()
+        self.connections = []
+        self.worker_processes = []
+
+
+def _local_sgd_worker(connection, network, shard, minibatch_size, momentum,
+                      cost, worker, replicas, seed):
+    """ Trains a replica of the network on a shard of the training data, an
+    epoch of a given number of steps at a time. Every tau steps and at the
+    end of the epoch it hands its params over in its row of the shared
+    replicas and carries on from whatever the coordinator left there.
+    After every epoch it sends the time it spent computing and copying its
+    params to and from its row. """
+
+    np.random.seed(seed)
+    params = network.params
+    workspace = SgdWorkspace(network, minibatch_size, cost)
+    minibatches = Minibatches(shard, minibatch_size)
+
+    while True:
+        command, payload = connection.recv()
+        if command == 'stop':
+            break
+        learning_rate, steps, tau = payload
+        workspace.reset_velocities()
+        compute_time = 0.0
+        communication_time = 0.0
+        costs = []
+        started = time.time()
+        for step, (xs, ys) in enumerate(itertools.islice(minibatches, steps)):
+            costs.append(workspace.step(xs, ys, learning_rate, momentum))
+            if (step + 1) % tau == 0 or step == steps - 1:
+                compute_time += time.time() - started
+                started = time.time()
+                replicas[worker] = params
+                communication_time += time.time() - started
+                connection.send(costs)
+                costs = []
+                connection.recv()
+                started = time.time()
+                params[...] = replicas[worker]
+                communication_time += time.time() - started
+                started = time.time()
+        connection.send((compute_time, communication_time))
+    connection.close()
+
+
+class LocalSgd(Sgd):
+    """ Local SGD: every one of a number of local worker processes trains
+    its own replica of the network on its own shard of the training data,
+    communicating only every tau steps. Then the replicas are either
+    pulled towards a centre model and it towards them (elastic averaging,
+    EASGD) or all replaced by their average (model averaging). The centre
+    (the average) is the network evaluated between epochs. Per epoch, the
+    wall time, the time the slowest worker spent computing and the time
+    spent communicating (the slowest worker's copies and the exchange) are
+    kept in timings, as by SyncSgd, the bytes sent and received by all the
+    workers together in communicated. """
+
+    EXCHANGES = ('elastic', 'average')
+
+    def __init__(self, workers=2, exchange='elastic', tau=10,
+                 elasticity=None):
+        """ :param workers: number of worker processes (replicas)
+        :param exchange: 'elastic' or 'average'
+        :param tau: steps every replica takes between communications
+        :param elasticity: how far the replicas and the centre move
+            towards each other, 0.9/workers by default """
+
+        if exchange not in self.EXCHANGES:
+            raise ValueError("Unknown exchange: %s" % exchange)
+
+        super(LocalSgd, self).__init__()
+        self.workers = workers
+        self.exchange = exchange
+        self.tau = tau
+        self.elasticity = \
+            0.9 / workers if elasticity is None else elasticity
+        self.connections = []
+        self.worker_processes = []
+        self.shard_sizes = []
+        self.replicas = None
+        self.centre = None
+        self.timings = []
+        self.communicated = []
+
+    def start(self, network, training_data, minibatch_size, momentum):
+        """ Starts the workers with replicas of the network, each on its
+        shard of the training data. """
+
+        self.network = network
+        self.training_data = training_data
+        self.minibatch_size = minibatch_size
+        self.momentum = momentum
+
+        size = param_count(network)
+        self.replicas = parallel.shared_array((self.workers, size),
+                                              network.dtype)
+        self.centre = network.params.copy()
+
+        feats, labels = training_data
+        log.debug("Starting %d SGD replicas...", self.workers)
+        shards = np.array_split(np.arange(len(feats)), self.workers)
+        for worker, shard in enumerate(shards):
+            shard = slice(shard[0], shard[-1] + 1)
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=parallel.run_worker,
+                args=(_local_sgd_worker, worker_connection, network,
+                      (feats[shard], labels[shard]), minibatch_size,
+                      momentum, self.cost, worker, self.replicas,
+                      np.random.randint(2**16))
+            )
+            process.daemon = True
+            process.start()
+            self.connections.append(connection)
+            self.worker_processes.append(process)
+            self.shard_sizes.append(shard.stop - shard.start)
+
+    def communicate(self):
+        """ Moves the replicas and the centre towards each other, or sets
+        them all to the average of the replicas. """
+
+        if self.exchange == 'elastic':
+            differences = self.elasticity * (self.replicas - self.centre)
+            self.replicas -= differences
+            self.centre += np.sum(differences, axis=0)
+        else:
+            self.centre[...] = np.mean(self.replicas, axis=0)
+            self.replicas[...] = self.centre
+
+    def barrier(self):
+        """ Waits for every worker, returning what they sent. If a worker
+        failed, stops them all and raises its WorkerError. """
+
+        try:
+            return [parallel.receive(c) for c in self.connections]
+        except parallel.WorkerError:
+            self.terminate()
+            raise
+
+    def broadcast(self, message):
+        try:
+            for connection in self.connections:
+                parallel.send(connection, message)
+        except parallel.WorkerError:
+            self.terminate()
+            raise
+
+    def train_epoch(self, learning_rate):
+        started = time.time()
+        # The same number of steps for every replica, the shards being
+        # equal but for a sample.
+        steps = -(-min(self.shard_sizes) // self.minibatch_size)
+        self.broadcast(('epoch', (learning_rate, steps, self.tau)))
+
+        costs = []
+        rounds = 0
+        exchange_time = 0.0
+        for step in xrange(steps):
+            if (step + 1) % self.tau == 0 or step == steps - 1:
+                costs.extend(np.mean(self.barrier(), axis=0))
+                exchange_started = time.time()
+                self.communicate()
+                exchange_time += time.time() - exchange_started
+                rounds += 1
+                self.broadcast(None)
+
+        self.network.params[...] = self.centre
+
+        compute_time, communication_time = np.max(self.barrier(), axis=0)
+        self.timings.append((time.time() - started, compute_time,
+                             communication_time + exchange_time))
+        # Every replica sends its params and gets them back every round.
+        self.communicated.append(2 * rounds * self.replicas.nbytes)
+        log.info("Epoch took %.2fs, %.2fs of which computing and %.2fs "
+                 "communicating %.1f MB in %d rounds.",
+                 *(self.timings[-1] +
+                   (self.communicated[-1] / 2.0**20, rounds)))
+        return costs
+
+    def finish(self):
+        """ Stops the workers. """
+
+        for connection in self.connections:
+            connection.send(('stop', None))
+            connection.close()
+        for process in self.worker_processes:
+            process.join()
+        self.connections = []
+        self.worker_processes = []
+        self.shard_sizes = []
+
+    def terminate(self):
+        """ Stops the workers right away, e.g. once one of them failed. """
+
+        for connection in self.connections:
+            connection.close()
+        parallel.terminate(self.worker_processes)
+        self.connections = []
+        self.worker_processes = []
+        self.shard_sizes = []
@@ -1,4 +1,11 @@
+import collections
 import math
+import multiprocessing
+
+import layer
+from network import Network
+import parallel
+from pipeline import Minibatches
 from utils import Utils, CrossEntropyCost
 
 __author__ = 'Azatris'
@@ -32,17 +39,40 @@ class Evaluator(object):
         self.validation_errors = []
         self.training_costs = []
         self.validation_costs = []
+        # The network the last results returned by monitor belong to.
+        self.network = None
 
     def monitor(self, network):
         """ According to evaluator settings, evaluates and logs the
         cost and accuracy of a given network. """
 
         log.info("Training complete")
+        self.network = network
+        return self.record(self.evaluate(network))
+
+    def evaluate(self, network):
+        """ Returns the training accuracy, validation cost and validation
+        accuracy of a given network, None for those not monitored. """
 
+        training_accuracy = None
         if self.monitor_training_accuracy:
             training_accuracy = self.accuracy(
                 self.training_data, network, convert=True
             )
+        validation_cost = None
+        if self.monitor_validation_cost:
+            validation_cost = self.total_cost(
+                self.cost_function, self.validation_data, network, convert=True
+            )
+        validation_accuracy = self.accuracy(self.validation_data, network)
+        return training_accuracy, validation_cost, validation_accuracy
+
+    def record(self, results):
+        """ Logs and keeps the results of evaluate. Returns the validation
+        accuracy. """
+
+        training_accuracy, validation_cost, validation_accuracy = results
+        if training_accuracy is not None:
             log.info(
                 "Training accuracy: \t%d / %d",
                 training_accuracy, len(self.training_data[0])
@@ -53,10 +83,7 @@ class Evaluator(object):
                 )
             )
 
-        if self.monitor_validation_cost:
-            validation_cost = self.total_cost(
-                self.cost_function, self.validation_data, network, convert=True
-            )
+        if validation_cost is not None:
             log.info(
                 "Validation cost: %f",
                 validation_cost
@@ -65,7 +92,6 @@ class Evaluator(object):
                 validation_cost
             )
 
-        validation_accuracy = self.accuracy(self.validation_data, network)
         log.info(
             "Validation accuracy: \t%d / %d",
             validation_accuracy, len(self.validation_data[0])
@@ -80,6 +106,12 @@ class Evaluator(object):
         self.minibatches_count = 0
         return validation_accuracy
 
+    def finish(self):
+        """ Returns the validation accuracies of the networks whose results
+        are still to come, each with its network. """
+
+        return []
+
     def log_training_costs(self, training_cost):
         self.minibatches_count += 1
         if self.monitor_training_cost:
@@ -96,41 +128,148 @@ class Evaluator(object):
 
     @staticmethod
     def total_cost(cost_type, data, network, convert=False, chunk_size=5000):
-        """ Calculates the cost of given data against the network.
+        """ Calculates the cost of given data against the network. The cost
+        of a softmax top layer is computed from its linear activations if
+        the cost can (see CrossEntropyCost.softmax_fn_delta).
         :param convert: labels digit -> one-hot """
 
-        cost = []
-        feats, labels = data
-        chunks = len(feats)/chunk_size
-        feats_split = np.split(feats, chunks)
-        labels_split = np.split(labels, chunks)
-        for mini_feats, mini_labels in zip(feats_split, labels_split):
-            a = network.feed_forward(mini_feats)
+        fused = isinstance(network.layers[-1], layer.Softmax) and \
+            hasattr(cost_type, 'softmax_fn_delta')
+        cost = 0.0
+        plan = network.plan(chunk_size)
+        for mini_feats, mini_labels in \
+                Minibatches(data, chunk_size, shuffle=False):
+            a = plan.forward(mini_feats, top_activation=not fused)
             if convert:
-                mini_labels = Utils.vectorize_digits(mini_labels)
-            cost.append(cost_type.fn(a, mini_labels))
-        return np.mean(cost)
+                mini_labels = Utils.vectorize_digits(mini_labels, a.dtype)
+            if fused:
+                mini_cost, _ = cost_type.softmax_fn_delta(a, mini_labels, a)
+            else:
+                mini_cost = cost_type.fn(a, mini_labels)
+            cost += mini_cost * len(mini_feats)
+        return cost / len(data[0])
 
     @staticmethod
     def accuracy(data, network, convert=False, chunk_size=5000):
         """ Calculates the accuracy of given data against the network.
         :param convert: labels one-hot -> digit """
 
-        feats, labels = data
-        if convert:
-            labels = np.argmax(labels, axis=1)
-        if len(feats) > chunk_size and len(labels) > chunk_size:
-            feats_split = np.split(feats, len(feats)/chunk_size)
-            labels_split = np.split(labels, len(labels)/chunk_size)
-        else:
-            feats_split = [feats]
-            labels_split = [labels]
         accurate_results = 0
-        for mini_feats, mini_labels in zip(feats_split, labels_split):
-            mini_label_estimates = np.argmax(
-                network.feed_forward(mini_feats), axis=1
-            )
+        plan = network.plan(chunk_size)
+        for mini_feats, mini_labels in \
+                Minibatches(data, chunk_size, shuffle=False):
+            if convert:
+                mini_labels = np.argmax(mini_labels, axis=1)
+            mini_label_estimates = plan.labels(mini_feats)
             accurate_results += np.sum(
                 np.equal(mini_label_estimates, mini_labels)
             )
-        return accurate_results
\ No newline at end of file
+        return accurate_results
+
+
+def _evaluation_worker(connection, evaluator):
+    """ Evaluates the snapshots of the network it receives, one by one. """
+
+    while True:
+        snapshot = connection.recv()
+        if snapshot is None:
+            break
+        network = Network(layers=[
+            getattr(layer, type_name)(weights=weights, biases=biases)
+            for type_name, weights, biases in snapshot
+        ])
+        connection.send(evaluator.evaluate(network))
+    connection.close()
+
+
+class AsyncEvaluator(Evaluator):
+    """ Evaluator which scores snapshots of the network in a background
+    process while training carries on. monitor returns the results of the
+    snapshot taken lag epochs earlier, waiting for them only if they are
+    not ready yet, and None for the first lag epochs. The network those
+    results belong to is kept as network, for the scheduler to keep the
+    best one. """
+
+    def __init__(self, training_data, validation_data, lag=1, **kwargs):
+        """ :param lag: epochs by which the results lag behind, 0 to wait
+            for them right away """
+
+        super(AsyncEvaluator, self).__init__(
+            training_data, validation_data, **kwargs
+        )
+        self.lag = lag
+        self.pending = collections.deque()
+        self.connection = None
+        self.process = None
+
+    def start(self):
+        """ Forks the worker, which shares the data with this process. """
+
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=parallel.run_worker,
+            args=(_evaluation_worker, worker_connection, self)
+        )
+        self.process.daemon = True
+        self.process.start()
+
+    def monitor(self, network):
+        log.info("Training complete")
+        if self.process is None:
+            self.start()
+
+        snapshot = [(type(L).__name__, L.weights.copy(), L.biases.copy())
+                    for L in network.layers]
+        try:
+            parallel.send(self.connection, snapshot)
+        except parallel.WorkerError:
+            self.terminate()
+            raise
+        self.pending.append(snapshot)
+
+        validation_accuracy = None
+        while len(self.pending) > self.lag:
+            validation_accuracy = self.receive()
+        return validation_accuracy
+
+    def receive(self):
+        """ Waits for the results of the oldest pending snapshot. Raises a
+        WorkerError with the worker's traceback if it failed, having
+        stopped it. """
+
+        try:
+            results = parallel.receive(self.connection)
+        except parallel.WorkerError:
+            self.terminate()
+            raise
+        self.network = Network(layers=[
+            getattr(layer, type_name)(weights=weights, biases=biases)
+            for type_name, weights, biases in self.pending.popleft()
+        ])
+        return self.record(results)
+
+    def finish(self):
+        """ Waits for the results still to come and stops the worker. """
+
+        results = []
+        try:
+            while self.pending:
+                results.append((self.receive(), self.network))
+        except Exception:
+            self.terminate()
+            raise
+        if self.process is not None:
+            self.connection.send(None)
+            self.connection.close()
+            self.process.join()
+            self.process = None
+        return results
+
+    def terminate(self):
+        """ Stops the worker right away, dropping the pending snapshots. """
+
+        if self.process is not None:
+            self.connection.close()
+            parallel.terminate([self.process])
+            self.process = None
+        self.pending.clear()
@@ -29,7 +29,7 @@ def load_data():
         return training_data, validation_data, test_data
 
 
-def load_data_revamped():
+def load_data_revamped(dtype=np.float64):
     """ Return MNIST data as a 3-tuple containing the training data,
     the validation data and the test data in a revamped form
     more suitable for training neural networks. (ref:
@@ -42,20 +42,25 @@ def load_data_revamped():
 
     ``validation_data`` and ``test_data`` are similar to
     ``training_data``, but instead having 10,000 tuples of (x, y)
-    and where y remains a single digit from 0 to 9. """
+    and where y remains a single digit from 0 to 9.
+
+    All the images and one-hot labels are of a given dtype, e.g. np.float32
+    for a single precision run. """
 
     raw_tr_data, raw_va_data, raw_te_data = load_data()
 
-    training_inputs = np.asarray([np.reshape(x, 784) for x in raw_tr_data[0]])
-    training_results = np.asarray(
-        [Utils.vectorize_digit(y) for y in raw_tr_data[1]]
+    training_inputs = np.asarray(
+        [np.reshape(x, 784) for x in raw_tr_data[0]], dtype
     )
+    training_results = Utils.vectorize_digits(raw_tr_data[1], dtype)
     training_data = (training_inputs, training_results)
 
-    validation_inputs = np.asarray([np.reshape(x, 784) for x in raw_va_data[0]])
+    validation_inputs = np.asarray(
+        [np.reshape(x, 784) for x in raw_va_data[0]], dtype
+    )
     validation_data = (validation_inputs,  raw_va_data[1])
 
-    test_inputs = np.asarray([np.reshape(x, 784) for x in raw_te_data[0]])
+    test_inputs = np.asarray([np.reshape(x, 784) for x in raw_te_data[0]], dtype)
     test_data = (test_inputs, raw_te_data[1])
 
     return training_data, validation_data, test_data
\ No newline at end of file
@@ -10,33 +10,65 @@ import logging
 log = logging.root
 
 
+def param_count(network):
+    """ Number of weights and biases of a network. """
+
+    return sum(L.weights.size + L.biases.size for L in network.layers)
+
+
+def param_views(flat, network):
+    """ Views of a flat array shaped like the weights and biases of every
+    layer of a network, layer after layer, weights first. """
+
+    views_w, views_b = [], []
+    offset = 0
+    for L in network.layers:
+        views_w.append(flat[offset:offset + L.weights.size]
+                       .reshape(L.weights.shape))
+        offset += L.weights.size
+        views_b.append(flat[offset:offset + L.biases.size])
+        offset += L.biases.size
+    return views_w, views_b
+
+
 class Network(object):
-    """ The most important object. It is a list of layers. """
+    """ The most important object. It is a list of layers. The params of
+    all the layers live in a single flat buffer, params, laid out as by
+    param_views, every layer's weights and biases being views of it. """
 
     def __init__(
-            self, architecture=None, initial_weight_magnitude=None, layers=None
+            self, architecture=None, initial_weight_magnitude=None, layers=None,
+            dtype=None, hidden_layer=layer.Sigmoid, rng=None
     ):
-        """ N layers where N-1 has a Sigmoid activation function,
-        Nth has Softmax.
+        """ N layers where N-1 has a Sigmoid (or hidden_layer) activation
+        function, Nth has Softmax.
         :param architecture: e.g. [784, 30, 10], starting from the
             input layer, finishing with output
         :param initial_weight_magnitude: weights are initially set
-            uniformly in range (-iwm, iwm) """
+            uniformly in range (-iwm, iwm)
+        :param dtype: of the params, e.g. np.float32 to train and infer
+            in single precision; float64 by default
+        :param hidden_layer: Layer type of the hidden layers, e.g.
+            layer.ReLU
+        :param rng: np.random.RandomState to initialise the params from,
+            by default every layer is seeded with 42 """
 
         if layers:
             self.layers = layers
             log.info("Created network based on given layers.")
         else:
             self.layers = [
-                layer.Sigmoid(
-                    neurons, inputs_per_neuron, initial_weight_magnitude
+                hidden_layer(
+                    neurons, inputs_per_neuron, initial_weight_magnitude,
+                    dtype=dtype, rng=rng
                 )
                 for neurons, inputs_per_neuron
                 in zip(architecture[1:], architecture[:-2])
             ]
             self.layers.append(
                 layer.Softmax(
-                    architecture[-1], architecture[-2], initial_weight_magnitude
+                    architecture[-1], architecture[-2], initial_weight_magnitude,
+                    dtype=dtype, rng=rng
                 )
             )
 
@@ -50,6 +82,65 @@ class Network(object):
                     L, self.layers[L].biases.shape
                 )
 
+        self.params = None
+        self._gradients = None
+        self._plans = {}
+        self.bind_params()
+
+    def __getstate__(self):
+        # Workspaces are not worth pickling (or deep copying).
+        state = dict(self.__dict__, _plans={})
+        state['_gradients'] = None
+        return state
+
+    def __setstate__(self, state):
+        # Unpickled (or deep copied) views are copies, bind them again.
+        self.__dict__.update(state)
+        self.bind_params(self.params)
+
+    def bind_params(self, params=None):
+        """ Makes the weights and biases of the layers views of a given
+        flat buffer (e.g. in shared memory) or of a new one, after copying
+        them into it. Returns the buffer.
+        :param params: flat array of param_count elements """
+
+        if params is None:
+            params = np.empty(param_count(self), self.dtype)
+        views_w, views_b = param_views(params, self)
+        for L, weights, biases in zip(self.layers, views_w, views_b):
+            weights[...] = L.weights
+            biases[...] = L.biases
+            L.weights = weights
+            L.biases = biases
+        self.params = params
+        self._gradients = None
+        return params
+
+    @property
+    def gradients(self):
+        """ A flat buffer laid out like params, e.g. for the gradients of a
+        cost w.r.t. them. Allocated once, on first use. """
+
+        if self._gradients is None:
+            self._gradients = np.zeros_like(self.params)
+        return self._gradients
+
+    def layer_params(self, idx_layer):
+        """ View of the params of a layer as a single matrix, its weights
+        with its biases appended as the last row. """
+
+        offset = sum(L.weights.size + L.biases.size
+                     for L in self.layers[:idx_layer])
+        rows, columns = self.layers[idx_layer].weights.shape
+        return self.params[offset:offset + (rows + 1)*columns] \
+            .reshape(rows + 1, columns)
+
+    @property
+    def dtype(self):
+        """ The dtype of the params, which activations are computed in. """
+
+        return self.layers[0].weights.dtype
+
     def feed_forward(self, x, return_all=False):
         """ Feed input x to the network to get an output.
         :param return_all: return all layers' activations instead of
@@ -63,6 +154,56 @@ class Network(object):
             return activations
         return activations[-1]
 
+    def feed_forward_into(self, x, outputs, chunk_size=5000):
+        """ Feeds inputs x forward chunk by chunk, writing the activations
+        of the layers into given arrays, one per layer from the first, e.g.
+        memory-mapped. Only a chunk's activations are held otherwise, so
+        the data can be much larger than memory. Fewer arrays than layers
+        stop the feed forward early. """
+
+        for start in xrange(0, len(x), chunk_size):
+            activations = x[start:start + chunk_size]
+            for L, output in zip(self.layers, outputs):
+                activations = L.feed_forward(activations)
+                output[start:start + len(activations)] = activations
+
+    def plan(self, batch_size):
+        """ The InferencePlan of the network for batches of up to a given
+        size, made on first use and kept. """
+
+        if batch_size not in self._plans:
+            self._plans[batch_size] = InferencePlan(self, batch_size)
+        return self._plans[batch_size]
+
+    def stream(self, chunks, probabilities=False, batch_size=5000):
+        """ Yields the predicted labels (or the output probabilities) of
+        every chunk of inputs of an iterable, in batches of up to
+        batch_size rows, so that the inputs can be arbitrarily large, e.g.
+        read from disk chunk by chunk. What is yielded is only valid until
+        the next one is requested. """
+
+        plan = self.plan(batch_size)
+        predict = plan.probabilities if probabilities else plan.labels
+        for chunk in chunks:
+            for start in xrange(0, len(chunk), batch_size):
+                yield predict(chunk[start:start + batch_size])
+
+    def predict(self, x, probabilities=False, batch_size=5000):
+        """ Returns the predicted labels (or the output probabilities) of
+        inputs x, e.g. a memory-mapped array, in batches of up to
+        batch_size rows. """
+
+        if probabilities:
+            out = np.empty((len(x), self.layers[-1].weights.shape[1]),
+                           self.dtype)
+        else:
+            out = np.empty(len(x), np.intp)
+        start = 0
+        for predicted in self.stream([x], probabilities, batch_size):
+            out[start:start + len(predicted)] = predicted
+            start += len(predicted)
+        return out
+
     def feed_backward(self, output_error, activations):
         """ Compute deltas for all layers by backpropagating the
         error from the last layer. Deltas are used for adjusting
@@ -78,6 +219,65 @@ class Network(object):
         return deltas
 
 
+class InferencePlan(object):
+    """ Feeds batches of up to a given size forward through a network with
+    no allocations per batch. Every layer computes its output in place in
+    one of two buffers allocated once, in turns, so that no other layer's
+    output is kept. Labels are the argmax of the top layer's linear
+    activations, which no activation of the layer types changes, so the
+    top activation is skipped for them. """
+
+    def __init__(self, network, batch_size):
+        self.network = network
+        self.batch_size = batch_size
+        self.dtype = network.dtype
+        width = max(L.weights.shape[1] for L in network.layers)
+        self.buffers = [np.empty(batch_size * width, self.dtype)
+                        for _ in xrange(2)]
+        self.inputs = None
+        self.predicted = np.empty(batch_size, np.intp)
+
+    def forward(self, x, top_activation=True):
+        """ Returns the output of the network (or the top layer's linear
+        activations) for a batch of inputs x, a view of a buffer of the
+        plan. """
+
+        rows = len(x)
+        assert rows <= self.batch_size
+        if x.dtype != self.dtype:
+            if self.inputs is None:
+                self.inputs = np.empty((self.batch_size, x.shape[1]),
+                                       self.dtype)
+            inputs = self.inputs[:rows]
+            inputs[...] = x
+            x = inputs
+        layers = self.network.layers
+        for idx, L in enumerate(layers):
+            columns = L.weights.shape[1]
+            # Contiguous, as a view of the first rows*columns elements.
+            out = self.buffers[idx % 2][:rows * columns] \
+                .reshape(rows, columns)
+            if idx == len(layers) - 1 and not top_activation:
+                L.linear_activations(x, out=out)
+            else:
+                L.feed_forward(x, out=out)
+            x = out
+        return x
+
+    def probabilities(self, x):
+        """ Output of the network for a batch of inputs x, a view of a
+        buffer of the plan. """
+
+        return self.forward(x)
+
+    def labels(self, x):
+        """ Predicted labels of a batch of inputs x, a view of a buffer of
+        the plan. """
+
+        return np.argmax(self.forward(x, top_activation=False), axis=1,
+                         out=self.predicted[:len(x)])
+
+
 class Io(object):
         @staticmethod
         def save(network, filename):
@@ -86,24 +286,68 @@ class Io(object):
             network_json = {"layers": [
                 {"weights": L.weights.tolist(),
                  "biases": L.biases.tolist(),
-                 "type": type(L).__name__}
+                 "type": type(L).__name__,
+                 "dtype": L.weights.dtype.name}
                 for L in network.layers
             ]}
             with open(filename, "w+") as f:
                 json.dump(network_json, f)
 
         @staticmethod
-        def load(filename):
+        def load(filename, dtype=None):
             """ Creates a copy of the network saved in JSON
-            in a given file. """
+            in a given file.
+            :param dtype: of the params, by default the saved one """
 
             with open(filename, "r") as f:
                 network_json = json.load(f)
                 layers = [
                     getattr(sys.modules[layer.__name__], L["type"])(
                         weights=np.array(L["weights"]),
-                        biases=np.array(L["biases"])
+                        biases=np.array(L["biases"]),
+                        dtype=dtype or L.get("dtype", "float64")
                     )
                     for L in network_json["layers"]
                 ]
-                return Network(layers=layers)
\ No newline at end of file
+                return Network(layers=layers)
+
+
+class Snapshot(object):
+    """ A copy of the params of a network in a single buffer allocated
+    once, e.g. to keep the best network found so far. Taking a snapshot is
+    a contiguous copy into the buffer, and only when a network is needed
+    again is it restored into one or materialised. The buffer can live in
+    a file on disk instead of memory, for large models. """
+
+    def __init__(self, network, filename=None):
+        """ :param filename: of an .npy file to memory-map the buffer to """
+
+        self.layer_types = [type(L) for L in network.layers]
+        shape = (param_count(network),)
+        if filename is None:
+            self.buffer = np.empty(shape, network.dtype)
+        else:
+            self.buffer = np.lib.format.open_memmap(
+                filename, mode='w+', dtype=network.dtype, shape=shape
+            )
+        self.weights, self.biases = param_views(self.buffer, network)
+
+    def take(self, network):
+        """ Copies the params of a network into the snapshot. """
+
+        np.copyto(self.buffer, network.params)
+
+    def restore(self, network):
+        """ Copies the snapshot into the params of a network, in place. """
+
+        np.copyto(network.params, self.buffer)
+
+    def materialise(self):
+        """ Returns a new network with the params of the snapshot. """
+
+        return Network(layers=[
+            layer_type(weights=np.array(weights), biases=np.array(biases))
+            for layer_type, weights, biases in zip(
+                self.layer_types, self.weights, self.biases
+            )
+        ])
@@ -0,0 +1,173 @@
+import ctypes
+import logging
+import multiprocessing
+import os
+import traceback
+from multiprocessing.sharedctypes import RawArray
+
+__author__ = 'Azatris'
+
+import numpy as np
+
+log = logging.root
+
+# Arrays handed to the workers of a SharedPool. Filled in by the pool
+# initializer in every worker, so they are inherited through fork rather
+# than pickled.
+_shared = {}
+
+
+def shared_array(shape, dtype=np.float64):
+    """ Allocates a numpy array backed by process-shared memory. Processes
+    forked after the allocation see (and write to) the very same buffer. """
+
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw = RawArray(ctypes.c_char, max(size * dtype.itemsize, 1))
+    return np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+
+def shared_copy(array):
+    """ Returns a copy of a given array in process-shared memory. """
+
+    array = np.asarray(array)
+    copy = shared_array(array.shape, array.dtype)
+    copy[...] = array
+    return copy
+
+
+def get_shared(name, *default):
+    """ Returns an array (or a list of arrays) that was registered under
+    a given name when the worker's pool was created, or a default, if
+    given, when nothing was. """
+
+    if default:
+        return _shared.get(name, default[0])
+    return _shared[name]
+
+
+class WorkerError(Exception):
+    """ An exception raised in a worker process, the message being the
+    worker's traceback. """
+    pass
+
+
+def run_worker(target, connection, *args):
+    """ Runs target(connection, *args) as the body of a worker process
+    talking to its parent through a pipe. An exception it raises is sent
+    back as ('error', traceback) for receive to raise in the parent, rather
+    than the worker dying silently and the parent getting an EOFError. """
+
+    try:
+        target(connection, *args)
+    except Exception:
+        try:
+            connection.send(('error', traceback.format_exc()))
+        except Exception:  # the parent is gone, or the pipe is broken
+            pass
+        connection.close()
+
+
+def receive(connection):
+    """ Receives a message from a worker run by run_worker, raising a
+    WorkerError with the worker's traceback if it failed. """
+
+    message = connection.recv()
+    if isinstance(message, tuple) and len(message) == 2 and \
+            isinstance(message[0], str) and message[0] == 'error' and \
+            isinstance(message[1], str):
+        raise WorkerError("Worker process failed:\n" + message[1])
+    return message
+
+
+def send(connection, message):
+    """ Sends a message to a worker run by run_worker. If the worker is
+    gone, having failed, raises its WorkerError rather than a broken pipe.
+    """
+
+    try:
+        connection.send(message)
+    except IOError:
+        receive(connection)
+        raise
+
+
+def terminate(processes):
+    """ Stops worker processes, e.g. the remaining ones once one of them
+    has failed. """
+
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+
+BLAS_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                         'MKL_NUM_THREADS')
+
+# Functions setting the thread count of BLAS libraries at run time.
+BLAS_THREAD_SETTERS = {'openblas': 'openblas_set_num_threads',
+                       'mkl_rt': 'MKL_Set_Num_Threads'}
+
+
+def pin_blas_threads(threads):
+    """ Limits BLAS to a number of threads in this process. The environment
+    covers libraries loaded from now on (and child processes), whereas
+    OpenBLAS or MKL already loaded, e.g. by numpy before a fork, are set
+    through ctypes. Returns the names of the libraries set so. """
+
+    for variable in BLAS_THREAD_VARIABLES:
+        os.environ[variable] = str(threads)
+
+    pinned = []
+    try:
+        with open('/proc/self/maps') as f:
+            libraries = set(line.split()[-1] for line in f
+                            if line.rstrip().endswith('.so') or '.so.' in line)
+    except IOError:
+        return pinned
+    for library in libraries:
+        name = os.path.basename(library)
+        for prefix, setter in BLAS_THREAD_SETTERS.items():
+            if prefix in name:
+                try:
+                    getattr(ctypes.CDLL(library), setter)(threads)
+                    pinned.append(name)
+                except (OSError, AttributeError):
+                    pass
+    return pinned
+
+
+def _init_worker(arrays, blas_threads=None):
+    _shared.clear()
+    _shared.update(arrays)
+    if blas_threads is not None:
+        pin_blas_threads(blas_threads)
+
+
+class SharedPool(object):
+    """ Process pool whose workers can read given shared arrays through
+    get_shared. The arrays must live in shared memory (see shared_array)
+    for the workers to see updates made by the parent after the pool has
+    been started. Relies on fork, i.e. Linux. """
+
+    def __init__(self, arrays, processes=None, blas_threads=None):
+        """ :param blas_threads: BLAS threads of every worker, see
+            pin_blas_threads """
+
+        self.pool = multiprocessing.Pool(
+            processes, initializer=_init_worker,
+            initargs=(arrays, blas_threads)
+        )
+        log.debug("Started shared pool with %d processes.",
+                  self.pool._processes)
+
+    def map(self, fn, tasks):
+        return self.pool.map(fn, tasks)
+
+    def imap_unordered(self, fn, tasks):
+        return self.pool.imap_unordered(fn, tasks)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
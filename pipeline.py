@@ -0,0 +1,93 @@
+import logging
+import Queue
+import threading
+
+__author__ = 'Azatris'
+
+import numpy as np
+
+log = logging.root
+
+
+class Minibatches(object):
+    """ Minibatches of a tuple of arrays sharing their first axis, e.g.
+    features and labels, the last minibatch possibly smaller. Iterating
+    gives an epoch of them. When shuffled, only a permutation of the
+    indices is drawn, and the rows are gathered into a few reusable
+    buffers, several minibatches to a buffer, by a background thread
+    ahead of the consumer. Otherwise the minibatches are just views of
+    consecutive rows. Either way, a minibatch is only valid until the next
+    one is requested. """
+
+    def __init__(self, arrays, minibatch_size, shuffle=True, prefetch=2,
+                 buffer_rows=4096):
+        """ :param prefetch: buffers gathered ahead at most
+        :param buffer_rows: rows per buffer, rounded up to whole minibatches
+        """
+
+        self.arrays = arrays
+        self.minibatch_size = int(minibatch_size)
+        self.shuffle = shuffle
+        self.prefetch = prefetch
+        self.buffer_rows = self.minibatch_size * \
+            max(1, -(-buffer_rows // self.minibatch_size))
+        self.buffers = None
+
+    def __len__(self):
+        return -(-len(self.arrays[0]) // self.minibatch_size)
+
+    def __iter__(self):
+        length = len(self.arrays[0])
+        if not self.shuffle:
+            for start in xrange(0, length, self.minibatch_size):
+                yield tuple(a[start:start + self.minibatch_size]
+                            for a in self.arrays)
+            return
+
+        if self.buffers is None:
+            self.buffers = [
+                [np.empty((self.buffer_rows,) + a.shape[1:], a.dtype)
+                 for a in self.arrays]
+                for _ in xrange(self.prefetch + 1)
+            ]
+        free = Queue.Queue()
+        ready = Queue.Queue()
+        for buffers in self.buffers:
+            free.put(buffers)
+        gatherer = threading.Thread(
+            target=self._gather,
+            args=(np.random.permutation(length), free, ready)
+        )
+        gatherer.daemon = True
+        gatherer.start()
+
+        try:
+            while True:
+                item = ready.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                buffers, rows = item
+                for start in xrange(0, rows, self.minibatch_size):
+                    stop = min(start + self.minibatch_size, rows)
+                    yield tuple(b[start:stop] for b in buffers)
+                free.put(buffers)
+        finally:
+            # Stops the gatherer if the epoch was not consumed to its end.
+            free.put(None)
+            gatherer.join()
+
+    def _gather(self, permutation, free, ready):
+        try:
+            for start in xrange(0, len(permutation), self.buffer_rows):
+                buffers = free.get()
+                if buffers is None:
+                    return
+                rows = permutation[start:start + self.buffer_rows]
+                for a, b in zip(self.arrays, buffers):
+                    np.take(a, rows, axis=0, out=b[:len(rows)], mode='clip')
+                ready.put((buffers, len(rows)))
+            ready.put(None)
+        except Exception as e:
+            ready.put(e)
@@ -0,0 +1,53 @@
+__author__ = 'Azatris'
+
+import copy
+import logging
+import sys
+import numpy as np
+
+from distributed import LocalSgd, SyncSgd
+from evaluator import Evaluator
+import network
+import mnist_loader
+import scheduler
+
+
+""" Sandbox. Compares local SGD (elastic and model averaging) against
+synchronous SGD by accuracy per wall-clock second and by communication
+volume. """
+
+# The logging initialization should be more general and taken out of run.py.
+log = logging.root
+log.setLevel(logging.INFO)
+formatter = logging.Formatter("[%(levelname)s %(asctime)s] %(message)s", "%H:%M:%S")
+handler_stream = logging.StreamHandler(sys.stdout)
+handler_stream.setFormatter(formatter)
+log.addHandler(handler_stream)
+
+tr_d, va_d, te_d = mnist_loader.load_data_revamped()
+
+architecture = [784, 400, 400, 10]
+net = network.Network(architecture, 0.1)
+workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+tau = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+trainers = [
+    ('sync', SyncSgd(workers=workers), 10 * workers),
+    ('elastic', LocalSgd(workers=workers, exchange='elastic', tau=tau), 10),
+    ('average', LocalSgd(workers=workers, exchange='average', tau=tau), 10)
+]
+for name, trainer, minibatch_size in trainers:
+    evaluator = Evaluator(tr_d, va_d, monitor_training_accuracy=False,
+                          log_interval=0)
+    trainer.sgd(
+        copy.deepcopy(net),
+        (tr_d[0].copy(), tr_d[1].copy()),
+        minibatch_size,
+        evaluator=evaluator,
+        scheduler=scheduler.ListScheduler(max_epochs=5))
+    for wall, communicated, error in zip(
+            np.cumsum([wall for wall, _, _ in trainer.timings]),
+            np.cumsum(trainer.communicated),
+            evaluator.validation_errors):
+        log.info("%s: %.1fs, %.1f MB, validation accuracy %.2f%%",
+                 name, wall, communicated / 2.0**20, (1 - error) * 100)
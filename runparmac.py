@@ -0,0 +1,48 @@
+__author__ = 'Azatris'
+
+import copy
+import logging
+import sys
+import numpy as np
+
+from distributed import DistributedMac
+import network
+import mnist_loader
+
+
+""" Sandbox. Measures the speed-up of distributed MAC against the number of
+workers. """
+
+# The logging initialization should be more general and taken out of run.py.
+log = logging.root
+log.setLevel(logging.INFO)
+formatter = logging.Formatter("[%(levelname)s %(asctime)s] %(message)s", "%H:%M:%S")
+handler_stream = logging.StreamHandler(sys.stdout)
+handler_stream.setFormatter(formatter)
+log.addHandler(handler_stream)
+
+tr_d, va_d, te_d = mnist_loader.load_data_revamped()
+
+# Subset the data
+data_size = 5000
+tr_d = (np.asarray(tr_d[0][:data_size]), np.asarray(tr_d[1][:data_size]))
+
+architecture = [784, 400, 400, 10]
+net = network.Network(architecture, 0.1)
+exchange = sys.argv[1] if len(sys.argv) > 1 else 'circulate'
+
+step_times = {}
+for workers in [1, 2, 4, 8]:
+    trainer = DistributedMac(
+        copy.deepcopy(net),
+        (tr_d[0].copy(), tr_d[1].copy()),
+        va_d,
+        workers=workers,
+        w_step_exchange=exchange)
+    trainer.train()
+    step_times[workers] = sum(
+        np.mean([wall for wall, _ in trainer.timings[step]])
+        for step in ['w_step', 'a_step']
+    )
+    log.info("%d workers: %.2fs per iteration, speed-up %.2f",
+             workers, step_times[workers], step_times[1] / step_times[workers])
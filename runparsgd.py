@@ -0,0 +1,44 @@
+__author__ = 'Azatris'
+
+import copy
+import logging
+import sys
+import numpy as np
+
+from distributed import SyncSgd
+import network
+import mnist_loader
+import scheduler
+
+
+""" Sandbox. Measures the scaling efficiency of synchronous data-parallel
+SGD against the number of workers. """
+
+# The logging initialization should be more general and taken out of run.py.
+log = logging.root
+log.setLevel(logging.INFO)
+formatter = logging.Formatter("[%(levelname)s %(asctime)s] %(message)s", "%H:%M:%S")
+handler_stream = logging.StreamHandler(sys.stdout)
+handler_stream.setFormatter(formatter)
+log.addHandler(handler_stream)
+
+tr_d, va_d, te_d = mnist_loader.load_data_revamped()
+
+architecture = [784, 400, 400, 10]
+net = network.Network(architecture, 0.1)
+minibatch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+
+epoch_times = {}
+for workers in [1, 2, 4, 8]:
+    trainer = SyncSgd(workers=workers)
+    trainer.sgd(
+        copy.deepcopy(net),
+        (tr_d[0].copy(), tr_d[1].copy()),
+        minibatch_size,
+        scheduler=scheduler.ListScheduler(max_epochs=2))
+    wall, compute, communication = np.mean(trainer.timings, axis=0)
+    epoch_times[workers] = wall
+    log.info("%d workers: %.2fs per epoch (%.2fs computing, %.2fs "
+             "communicating), speed-up %.2f, efficiency %.2f",
+             workers, wall, compute, communication,
+             epoch_times[1] / wall, epoch_times[1] / wall / workers)
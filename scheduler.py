@@ -1,9 +1,15 @@
 from abc import ABCMeta, abstractmethod
-import copy
 import logging
+import multiprocessing
+import os
 
 __author__ = 'Azatris'
 
+import numpy as np
+
+from network import Snapshot
+import parallel
+
 log = logging.root
 
 
@@ -67,8 +73,11 @@ class DecayScheduler(Scheduler):
     def __init__(
             self, init_learning_rate=0.1,
             decay_threshold=3, decay=0.01,
-            stop_threshold=10, max_epochs=99
+            stop_threshold=10, max_epochs=99, spill_dir=None
     ):
+        """ :param spill_dir: if given, the most accurate params are kept
+            in a file there instead of in memory """
+
         self.learning_rate = init_learning_rate
         self.decay_threshold = decay_threshold
         self.decay = decay
@@ -78,22 +87,31 @@ class DecayScheduler(Scheduler):
         self.no_improvements_stop = 0
         self.no_improvements_decay = 0
         self.highest_accuracy = 0
-        self.highest_accuracy_network = None
+        self.spill_dir = spill_dir
+        self.snapshot = None
         self.epoch = 0
 
         super(Scheduler, self).__init__()
 
     def compute_next_learning_rate(self, accuracy=None, network=None):
+        """ Counts an epoch without an accuracy as one without improvement,
+        e.g. when training without an evaluator, unless there is no
+        network either, i.e. the results of the epoch are still to come
+        (from an evaluator lagging behind). """
+
         # Update no-improvements counter
-        if accuracy > self.highest_accuracy:
-            self.highest_accuracy = accuracy
-            log.info("Highest accuracy network so far: %s", accuracy)
-            self.highest_accuracy_network = copy.deepcopy(network)
-            self.no_improvements_stop = 0
-            self.no_improvements_decay = 0
-        else:
-            self.no_improvements_stop += 1
-            self.no_improvements_decay += 1
+        if accuracy is not None or network is not None:
+            if accuracy is not None and accuracy > self.highest_accuracy:
+                self.highest_accuracy = accuracy
+                log.info("Highest accuracy network so far: %s", accuracy)
+                if self.snapshot is None:
+                    self.snapshot = Snapshot(network, self.spill_filename())
+                self.snapshot.take(network)
+                self.no_improvements_stop = 0
+                self.no_improvements_decay = 0
+            else:
+                self.no_improvements_stop += 1
+                self.no_improvements_decay += 1
 
         # Change learning rate or stop completely
         if self.no_improvements_stop >= self.stop_threshold or \
@@ -109,3 +127,114 @@ class DecayScheduler(Scheduler):
 
     def get_learning_rate(self):
         return self.learning_rate
+
+    def spill_filename(self):
+        if self.spill_dir is None:
+            return None
+        if not os.path.isdir(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        return os.path.join(self.spill_dir, 'highest_accuracy_network.npy')
+
+    @property
+    def highest_accuracy_network(self):
+        """ A new network with the most accurate params so far, if any. """
+
+        if self.snapshot is None:
+            return None
+        return self.snapshot.materialise()
+
+
+class Rungs(object):
+    """ Validation accuracies reported by the trials of a sweep at every
+    rung of successive halving, in shared memory so that trials running in
+    the processes of a pool (forked after its creation) see each other's.
+    Rung k is reached after min_epochs * reduction**k evaluated epochs. """
+
+    def __init__(self, capacity, rungs=4, min_epochs=1, reduction=3):
+        """ :param capacity: trials reporting at most, e.g. of a sweep
+        :param reduction: a trial goes on past a rung only if among the
+            best 1/reduction of the trials that have reported there """
+
+        self.capacity = capacity
+        self.min_epochs = min_epochs
+        self.reduction = reduction
+        self.milestones = [min_epochs * reduction ** k for k in xrange(rungs)]
+        self.accuracies = parallel.shared_array((rungs, capacity))
+        self.counts = parallel.shared_array((rungs,), np.int64)
+        self.lock = multiprocessing.Lock()
+
+    def report(self, rung, accuracy):
+        """ Records a trial's accuracy at a rung. Returns whether the trial
+        should go on, i.e. whether it is among the best 1/reduction (rounded
+        up) of the trials recorded at the rung so far, itself included, a
+        tie going to the trial recorded first. The first trial at a rung
+        thus always goes on. """
+
+        with self.lock:
+            count = int(self.counts[rung])
+            recorded = self.accuracies[rung, :count]
+            rank = int(np.sum(recorded >= accuracy))
+            if count < self.capacity:
+                self.accuracies[rung, count] = accuracy
+                self.counts[rung] = count = count + 1
+        return rank < -(-count // self.reduction)
+
+    def seed(self, trials):
+        """ Records the accuracies of trials done before, e.g. of a sweep
+        being resumed, for the trials to come to be compared with. Each is
+        a list of a trial's accuracies at the rungs it reached, the first
+        rung first. """
+
+        with self.lock:
+            for accuracies in trials:
+                for rung, accuracy in enumerate(accuracies[:len(self.counts)]):
+                    count = int(self.counts[rung])
+                    if count < self.capacity:
+                        self.accuracies[rung, count] = accuracy
+                        self.counts[rung] = count + 1
+
+
+class SuccessiveHalvingScheduler(Scheduler):
+    """ Stops a trial of a sweep early if it is doing worse than most of
+    the others at a rung (see Rungs), i.e. asynchronous successive halving
+    (ASHA) in its stopping form: trials are not held back waiting to be
+    promoted, but stopped as soon as they fall behind. Otherwise, learning
+    rates are those of a given scheduler, whose attributes (e.g. epoch,
+    snapshot) are those of this one. The accuracies reported at the rungs
+    are kept in reported, e.g. for Rungs.seed. """
+
+    def __init__(self, scheduler, rungs):
+        self.scheduler = scheduler
+        self.rungs = rungs
+        self.evaluations = 0
+        self.rung = 0
+        self.reported = []
+        self.stopped = False
+
+        super(Scheduler, self).__init__()
+
+    def __getattr__(self, name):
+        # Only called for attributes not of this scheduler itself
+        if name == 'scheduler':
+            raise AttributeError(name)
+        return getattr(self.scheduler, name)
+
+    def compute_next_learning_rate(self, accuracy=None, network=None):
+        self.scheduler.compute_next_learning_rate(accuracy, network)
+        if accuracy is None or self.stopped:
+            return
+
+        self.evaluations += 1
+        if self.rung < len(self.rungs.milestones) and \
+                self.evaluations == self.rungs.milestones[self.rung]:
+            self.reported.append(float(accuracy))
+            if not self.rungs.report(self.rung, accuracy):
+                self.stopped = True
+                log.info("Stopped at rung %d after %d epochs, accuracy %s.",
+                         self.rung, self.evaluations, accuracy)
+            self.rung += 1
+
+    def get_learning_rate(self):
+        if self.stopped:
+            return 0
+        return self.scheduler.get_learning_rate()
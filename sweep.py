@@ -0,0 +1,290 @@
+import hashlib
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import time
+
+__author__ = 'Azatris'
+
+import numpy as np
+
+from evaluator import Evaluator
+from network import Io, Network
+import mnist_loader
+import parallel
+from pipeline import Minibatches
+from scheduler import DecayScheduler, Rungs, SuccessiveHalvingScheduler
+from trainer import Sgd
+from utils import Utils
+
+log = logging.root
+
+# Hyperparameters of an SGD trial not given by its config, as run.py had.
+SGD_DEFAULTS = {
+    'learning_rate': 0.1,
+    'momentum': 0.6,
+    'decay': 0.01,
+    'decay_threshold': 2,
+    'stop_threshold': 10,
+    'minibatch_size': 10,
+    'max_epochs': 99,
+    'architecture': [784, 400, 400, 10],
+    'weight_magnitude': 0.1,
+    'training_size': None,
+    'seed': 42,
+    'save_dir': None
+}
+
+
+def grid(space):
+    """ Yields every combination of the values listed for every
+    hyperparameter in a given space, e.g. {'momentum': [0.5, 0.9]}. """
+
+    names = sorted(space)
+    for values in itertools.product(*[space[name] for name in names]):
+        yield dict(zip(names, values))
+
+
+def random_search(space, trials, seed=0):
+    """ Yields a number of configs drawn from a given space, where every
+    hyperparameter has either a list of values to choose from or a
+    (low, high) range to draw uniformly from, on a log scale if both are
+    positive and high/low is at least 100. The same seed yields the same
+    configs, so that a sweep can be resumed. """
+
+    rng = np.random.RandomState(seed)
+    names = sorted(space)
+    for _ in xrange(trials):
+        config = {}
+        for name in names:
+            values = space[name]
+            if isinstance(values, tuple):
+                low, high = values
+                if 0 < low and 100 * low <= high:
+                    value = float(np.exp(rng.uniform(np.log(low),
+                                                     np.log(high))))
+                else:
+                    value = float(rng.uniform(low, high))
+            else:
+                value = values[rng.randint(len(values))]
+            config[name] = value
+        yield config
+
+
+def load_mnist_shared(dtype=np.float64):
+    """ Loads MNIST into shared memory, as a list of the training,
+    validation and test features and labels, for the trials of a sweep to
+    share. """
+
+    tr_d, va_d, te_d = mnist_loader.load_data_revamped(dtype)
+    return [parallel.shared_copy(a) for data in (tr_d, va_d, te_d)
+            for a in data]
+
+
+def sgd_trial(config):
+    """ Trains a network by SGD with a DecayScheduler on the shared MNIST,
+    as run.py did, stopped early by successive halving if the sweep has
+    rungs. Returns the validation and test errors of the most
+    accurate network, the learning curves (the training cost at the
+    end of every epoch) and the accuracies reported at the rungs, if any.
+    The network is saved into save_dir, if given, as JSON named by a hash
+    of the config. """
+
+    config = dict(SGD_DEFAULTS, **config)
+    tr_x, tr_y, va_x, va_y, te_x, te_y = parallel.get_shared('mnist')
+    if config['training_size'] is not None:
+        tr_x = tr_x[:config['training_size']]
+        tr_y = tr_y[:config['training_size']]
+
+    net = Network(config['architecture'], config['weight_magnitude'],
+                  dtype=tr_x.dtype,
+                  rng=np.random.RandomState(config['seed']))
+    evaluator = Evaluator((tr_x, tr_y), (va_x, va_y), log_interval=0)
+    scheduler = DecayScheduler(
+        init_learning_rate=config['learning_rate'],
+        decay=config['decay'],
+        decay_threshold=config['decay_threshold'],
+        stop_threshold=config['stop_threshold'],
+        max_epochs=config['max_epochs']
+    )
+    rungs = parallel.get_shared('rungs', None)
+    if rungs is not None:
+        scheduler = SuccessiveHalvingScheduler(scheduler, rungs)
+    trainer = Sgd()
+    # The minibatches are shuffled by the global RNG, which the trainer
+    # has just seeded with 42.
+    np.random.seed(config['seed'])
+    trainer.sgd(net, (tr_x, tr_y), config['minibatch_size'],
+                momentum=config['momentum'], evaluator=evaluator,
+                scheduler=scheduler)
+
+    filename = None
+    if config['save_dir'] is not None:
+        if not os.path.isdir(config['save_dir']):
+            try:
+                os.makedirs(config['save_dir'])
+            except OSError:  # made by a trial running alongside meanwhile
+                pass
+        filename = os.path.join(
+            config['save_dir'],
+            hashlib.sha1(SweepStore.key(config)).hexdigest()[:12] + '.json'
+        )
+        Io.save(net, filename)
+
+    minibatches = len(Minibatches((tr_x,), config['minibatch_size']))
+    return {
+        'validation_error': Utils.error_fraction(
+            Evaluator.accuracy((va_x, va_y), net), len(va_x)
+        ),
+        'test_error': Utils.error_fraction(
+            Evaluator.accuracy((te_x, te_y), net), len(te_x)
+        ),
+        'epochs': scheduler.epoch,
+        'stopped_early': getattr(scheduler, 'stopped', False),
+        'training_costs':
+            evaluator.training_costs[minibatches-1::minibatches],
+        'validation_costs': evaluator.validation_costs,
+        'training_errors': evaluator.training_errors,
+        'validation_errors': evaluator.validation_errors,
+        'rung_accuracies': getattr(scheduler, 'reported', []),
+        'network': filename
+    }
+
+
+def _run_trial(task):
+    """ Runs a trial in a worker of the sweep's pool. A failing trial is
+    reported rather than failing the sweep. """
+
+    trial, config = task
+    started = time.time()
+    try:
+        status, results = 'done', trial(config)
+    except Exception as e:
+        log.exception("Trial %s failed.", config)
+        status, results = 'failed', {'error': repr(e)}
+    return config, status, time.time() - started, results
+
+
+class SweepStore(object):
+    """ Results of the trials of a sweep in an SQLite database, a row per
+    trial keyed by its config. The config and all the results are kept as
+    JSON, the errors also as columns to query by. """
+
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS trials ("
+            "key TEXT PRIMARY KEY, config TEXT, status TEXT, "
+            "validation_error REAL, test_error REAL, seconds REAL, "
+            "results TEXT)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def key(config):
+        return json.dumps(config, sort_keys=True)
+
+    def done(self):
+        """ Keys of the trials done, i.e. not to be run again. """
+
+        return set(key for key, in self.connection.execute(
+            "SELECT key FROM trials WHERE status = 'done'"
+        ))
+
+    def record(self, config, status, seconds, results):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (self.key(config), json.dumps(config), status,
+             results.get('validation_error'), results.get('test_error'),
+             seconds, json.dumps(results))
+        )
+        self.connection.commit()
+
+    def rung_accuracies(self):
+        """ Accuracies at the rungs of successive halving of every trial
+        done that reported any, see Rungs.seed. """
+
+        return [accuracies for accuracies in (
+            json.loads(results).get('rung_accuracies')
+            for results, in self.connection.execute(
+                "SELECT results FROM trials WHERE status = 'done'"
+            )
+        ) if accuracies]
+
+    def results(self, limit=None):
+        """ Configs and results of the trials done, the lowest validation
+        error first. """
+
+        query = "SELECT config, seconds, results FROM trials " \
+                "WHERE status = 'done' ORDER BY validation_error"
+        if limit is not None:
+            query += " LIMIT %d" % limit
+        return [dict(json.loads(results), config=json.loads(config),
+                     seconds=seconds)
+                for config, seconds, results in self.connection.execute(query)]
+
+    def close(self):
+        self.connection.close()
+
+
+class Sweep(object):
+    """ Runs a trial function on every config of a search space (see grid
+    and random_search) in a pool of processes, recording the results in a
+    SweepStore. Trials already done in the store are skipped, so an
+    interrupted sweep is resumed by running it again. The given shared
+    arrays (see load_mnist_shared) are handed to the trials through
+    parallel.get_shared, as are the rungs of successive halving, if any.
+    Trials returning their 'rung_accuracies' (as sgd_trial does) have them
+    kept in the store, and the rungs of a resumed sweep start from them.
+    """
+
+    def __init__(self, trial, configs, store, arrays, processes=None,
+                 blas_threads=1, halving=None):
+        """ :param arrays: dict of shared arrays by name, e.g.
+            {'mnist': load_mnist_shared()} for sgd_trial
+        :param halving: if given, a dict of the arguments of Rungs other
+            than capacity, e.g. {'min_epochs': 1, 'reduction': 3}, for the
+            trials to stop early by (see SuccessiveHalvingScheduler)
+        :param blas_threads: BLAS threads of every worker, so that the
+            trials running at once do not oversubscribe the cores """
+
+        self.trial = trial
+        self.configs = list(configs)
+        self.store = store
+        self.arrays = arrays
+        self.processes = processes
+        self.blas_threads = blas_threads
+        self.halving = halving
+
+    def run(self):
+        """ Runs the trials not done yet. Returns the number of them run.
+        """
+
+        done = self.store.done()
+        pending = [config for config in self.configs
+                   if self.store.key(config) not in done]
+        log.info("Sweep of %d trials, %d of them to run.",
+                 len(self.configs), len(pending))
+        if not pending:
+            return 0
+
+        arrays = self.arrays
+        if self.halving is not None:
+            previous = self.store.rung_accuracies()
+            rungs = Rungs(len(previous) + len(pending), **self.halving)
+            rungs.seed(previous)
+            arrays = dict(arrays, rungs=rungs)
+        pool = parallel.SharedPool(arrays, self.processes,
+                                   self.blas_threads)
+        try:
+            for config, status, seconds, results in pool.imap_unordered(
+                    _run_trial, [(self.trial, config) for config in pending]):
+                self.store.record(config, status, seconds, results)
+                log.info("Trial %s %s in %.0fs, validation error %s.",
+                         config, status, seconds,
+                         results.get('validation_error'))
+        finally:
+            pool.close()
+        return len(pending)
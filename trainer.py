@@ -1,9 +1,19 @@
+from abc import ABCMeta, abstractmethod
 import sys
 import gc
+import math
+import os
+import time
 
+from scipy.linalg import cho_factor, cho_solve
 from scipy.optimize import minimize
 
+from checkpoint import Checkpointer
+from layer import Sigmoid, SigmoidActivation, Softmax
+from network import param_count, param_views
 import evaluator as eva  # likely temporary, so it doesnt shadow sgd
+import parallel
+from pipeline import Minibatches
 from utils import CrossEntropyCost, Utils
 
 
@@ -26,156 +36,934 @@ class Trainer(object):
         np.random.seed(42)  # for consistent results
 
 
+class Subproblem(object):
+    """ Abstract MAC subproblem over a matrix of variables of a given shape,
+    solved with scipy.optimize through flattened cost, jac and hessp.
+    Those all evaluate the same layer at the same point in a row, so the
+    last feed forward is kept and reused. """
+    __metaclass__ = ABCMeta
+
+    SOLVERS = ('Newton-CG', 'trust-krylov', 'L-BFGS-B')
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.last_x = None
+        self.last_fk = None
+
+    @abstractmethod
+    def feed_forward(self, x):
+        """ Output of the layer at variables x, shaped as the problem. """
+        pass
+
+    @abstractmethod
+    def cost(self, x_flat):
+        """ Cost at flattened variables x_flat. """
+        pass
+
+    @abstractmethod
+    def jac(self, x_flat):
+        """ Gradient of the cost at x_flat, flattened. """
+        pass
+
+    @abstractmethod
+    def hessp(self, x_flat, p_flat):
+        """ Product of the Hessian of the cost at x_flat with p_flat,
+        flattened. """
+        pass
+
+    def forward(self, x_flat):
+        if self.last_x is None or not np.array_equal(x_flat, self.last_x):
+            self.last_x = np.array(x_flat, copy=True)
+            self.last_fk = self.feed_forward(x_flat.reshape(self.shape))
+        return self.last_fk
+
+    def curvature(self, fk):
+        """ Second derivative of the cost w.r.t. the linear activations of
+        the layer. """
+
+        if self.top:
+            return 1.0
+        dfk = fk*(1-fk)
+        return dfk*dfk + (fk - self.targets)*dfk*(1 - 2*fk)
+
+    def minimize(self, x, options, solver='Newton-CG'):
+        """ Returns the minimizer, of the dtype of x, and the solver's
+        evaluation counts. """
+
+        res = minimize(self.cost, x.flatten(),
+                       method=solver,
+                       jac=self.jac,
+                       hessp=None if solver == 'L-BFGS-B' else self.hessp,
+                       options=options)
+        return res.x.reshape(self.shape).astype(x.dtype), solver_stats(res)
+
+
+def solver_stats(res=None):
+    """ Iteration and evaluation counts of a scipy.optimize result, or
+    zeroes to sum them up from. """
+
+    return dict((key, getattr(res, key, 0))
+                for key in ('nit', 'nfev', 'njev', 'nhev'))
+
+
+def add_stats(total, stats):
+    for key in total:
+        total[key] += stats[key]
+    return total
+
+
+class WStepProblem(Subproblem):
+    """ W-step subproblem of a layer (or of a block of its output units):
+    fit params, i.e. weights with the biases appended as the last row, such
+    that the layer maps inputs onto targets in the least squares sense.
+    The top layer is fitted as linear, the hidden ones as sigmoidal. Every
+    output unit is a separate problem, so any block of columns of params
+    can be solved on its own. The inputs come with a column of ones
+    appended, so that the layer is a single product with params. """
+
+    def __init__(self, inputs, targets, top=False, direct=True):
+        """ :param inputs: inputs of the layer augmented by ones
+        :param direct: solve the (linear least squares) top layer directly
+            through its normal equations instead of iteratively """
+
+        self.inputs = inputs
+        self.targets = targets
+        self.top = top
+        self.direct = direct
+        super(WStepProblem, self).__init__(
+            (inputs.shape[1], targets.shape[1])
+        )
+
+    def feed_forward(self, params):
+        # scipy.optimize works in float64, the inputs need not be.
+        linear_activations = np.dot(self.inputs,
+                                    params.astype(self.inputs.dtype))
+        if self.top:
+            return linear_activations
+        return SigmoidActivation.forward(linear_activations,
+                                         out=linear_activations)
+
+    def backward(self, de_dfk):
+        """ Maps a matrix over the outputs onto one over the params. """
+
+        return np.ndarray.flatten(np.dot(self.inputs.T, de_dfk))
+
+    def cost(self, params_flat):
+        returnable = 0.5 * np.sum((self.targets - self.forward(params_flat))**2)
+        log.debug("Returnable w_step_f: %s", returnable)
+        return returnable
+
+    def jac(self, params_flat):
+        fk = self.forward(params_flat)
+        de_dfk = fk - self.targets
+        if not self.top:
+            de_dfk *= fk*(1-fk)
+        return self.backward(de_dfk)
+
+    def hessp(self, params_flat, p_flat):
+        return self.backward(
+            np.dot(self.inputs,
+                   p_flat.reshape(self.shape).astype(self.inputs.dtype)) *
+            self.curvature(self.forward(params_flat))
+        )
+
+    def solve_normal_equations(self):
+        """ Solves the linear least squares problem through the Gram matrix
+        of the inputs, slightly regularised against constant inputs. This
+        is done in float64 whatever the inputs' dtype, as single precision
+        Gram matrices of nearly saturated units need not be positive
+        definite. """
+
+        inputs = self.inputs.astype(np.float64, copy=False)
+        gram = np.dot(inputs.T, inputs)
+        gram[np.diag_indices_from(gram)] += 1e-8 * np.mean(np.diag(gram))
+        return cho_solve(cho_factor(gram), np.dot(inputs.T, self.targets))
+
+    def minimize(self, params, options, solver='Newton-CG'):
+        if self.top and self.direct:
+            return self.solve_normal_equations().astype(params.dtype), \
+                solver_stats()
+        return super(WStepProblem, self).minimize(params, options, solver)
+
+
+def _w_step_task(task):
+    """ Solves a W-step subproblem in a worker of Mac's pool. """
+
+    idx_layer, rows, start, stop, params, top, direct, options, solver = task
+    problem = WStepProblem(
+        parallel.get_shared('augmented')[idx_layer][rows],
+        parallel.get_shared('aux')[idx_layer+1][rows, start:stop],
+        top=top, direct=direct
+    )
+    return problem.minimize(params, options, solver)
+
+
+class AStepProblem(Subproblem):
+    """ A-step subproblem of the aux z of a hidden layer (or of a chunk of
+    its samples). Given the activation of the layer below, proximal, and
+    the aux of the layer above, targets, minimizes per sample
+        mu/2 ||z - proximal||^2 + c/2 ||targets - f(z)||^2
+    where f is the layer above (linear if top, sigmoidal otherwise). Every
+    sample (row of z) is a separate problem. """
+
+    def __init__(self, proximal, targets, weights, biases, mu, c, top=False):
+        self.proximal = proximal
+        self.targets = targets
+        self.weights = weights
+        self.biases = biases
+        self.mu = mu
+        self.c = c
+        self.top = top
+        super(AStepProblem, self).__init__(proximal.shape)
+
+    @staticmethod
+    def from_aux(aux, idx_layer_aux, rows,
+                 lower_weights, lower_biases, weights, biases, mu, c, top):
+        """ Sets up the subproblem of given rows (a slice or indices) of
+        aux[idx_layer_aux] where the lower layer maps aux[idx_layer_aux-1]
+        onto it. """
+
+        proximal = np.dot(aux[idx_layer_aux-1][rows], lower_weights)
+        proximal += lower_biases
+        SigmoidActivation.forward(proximal, out=proximal)
+        return AStepProblem(proximal, aux[idx_layer_aux+1][rows],
+                            weights, biases, mu, c, top)
+
+    def feed_forward(self, z):
+        linear_activations = np.dot(z, self.weights) + self.biases
+        if self.top:
+            return linear_activations
+        return SigmoidActivation.forward(linear_activations,
+                                         out=linear_activations)
+
+    def row_costs(self, z, rows=slice(None)):
+        """ Costs of the samples, or of the given rows only. """
+
+        return 0.5 * (
+            self.mu*np.sum((z - self.proximal[rows])**2, axis=1) +
+            self.c*np.sum((self.targets[rows] - self.feed_forward(z))**2,
+                          axis=1)
+        )
+
+    def cost(self, z_flat):
+        z = z_flat.reshape(self.shape)
+        returnable = 0.5 * (
+            self.mu*np.sum((z - self.proximal)**2) +
+            self.c*np.sum((self.targets - self.forward(z_flat))**2)
+        )
+        log.debug("Returnable a_step_f: %s", returnable)
+        return returnable
+
+    def jac(self, z_flat):
+        z = z_flat.reshape(self.shape)
+        fk = self.forward(z_flat)
+        de_dfk = fk - self.targets
+        if not self.top:
+            de_dfk *= fk*(1-fk)
+        return np.ndarray.flatten(
+            self.mu*(z - self.proximal) + self.c*np.dot(de_dfk, self.weights.T)
+        )
+
+    def hessp(self, z_flat, p_flat):
+        p = p_flat.reshape(self.shape)
+        return np.ndarray.flatten(self.mu*p + self.c*np.dot(
+            np.dot(p, self.weights)*self.curvature(self.forward(z_flat)),
+            self.weights.T
+        ))
+
+    def penalty(self, z):
+        """ The part of the penalised objective that z is solved for last:
+        its own quadratic penalty and, below the top layer, the error of
+        the top layer. Costs no more than a feed forward of the (narrow)
+        top layer. """
+
+        penalty = 0.5*self.mu*np.sum((z - self.proximal)**2)
+        if self.top:
+            penalty += 0.5*self.c*np.sum(
+                (self.targets - self.forward(z.flatten()))**2
+            )
+        return penalty
+
+    def solve_rows(self, z, iterations=5, cg_iterations=10, tol=1e-10,
+                   ftol=0.0, cg_decay=0.95):
+        """ Solves every sample as its own problem, all of them at once with
+        vectorized updates. With a linear layer above the problem is
+        quadratic with one and the same Hessian for every sample, so it is
+        solved directly. Otherwise batched Gauss-Newton steps are taken, the
+        Gauss-Newton systems being solved by conjugate gradients run on all
+        rows at once, and halved on rows where they do not decrease the
+        cost. Conjugate gradients start from the previous step decayed by
+        cg_decay. Stops early once no row's cost decreases by more than
+        ftol relatively. """
+
+        if self.top:
+            hessian = self.mu*np.eye(self.shape[1]) + \
+                self.c*np.dot(self.weights, self.weights.T)
+            rhs = self.mu*self.proximal + \
+                self.c*np.dot(self.targets - self.biases, self.weights.T)
+            return cho_solve(cho_factor(hessian), rhs.T).T
+
+        z = np.array(z, copy=True)
+        costs = self.row_costs(z)
+        step = None
+        for _ in xrange(iterations):
+            fk = self.feed_forward(z)
+            dfk = fk*(1-fk)
+            gradient = self.mu*(z - self.proximal) + \
+                self.c*np.dot((fk - self.targets)*dfk, self.weights.T)
+            curvature = self.c*dfk**2
+
+            def hessp(v):
+                return self.mu*v + np.dot(
+                    curvature*np.dot(v, self.weights), self.weights.T)
+
+            step = _batched_cg(
+                hessp, gradient, cg_iterations, tol,
+                None if step is None else cg_decay*step
+            )
+            previous_costs = costs.copy()
+
+            # Halve the step on rows that got worse, leave them be at last.
+            rows = np.arange(len(z))
+            for _ in xrange(4):
+                new_costs = self.row_costs(z[rows] + step[rows], rows)
+                improved = new_costs < costs[rows]
+                z[rows[improved]] += step[rows[improved]]
+                costs[rows[improved]] = new_costs[improved]
+                rows = rows[~improved]
+                if len(rows) == 0:
+                    break
+                step[rows] *= 0.5
+
+            if np.all(previous_costs - costs <= ftol*previous_costs):
+                break
+        return z
+
+
+def _batched_cg(hessp, gradient, iterations, tol, x0=None):
+    """ Solves hessp(x) = -gradient by conjugate gradients independently
+    for every row, where hessp is a row-wise symmetric positive definite
+    operator applied to all rows at once. Starts from x0 if given. """
+
+    if x0 is None:
+        x = np.zeros_like(gradient)
+        r = -gradient
+    else:
+        x = x0
+        r = -gradient - hessp(x0)
+    p = r.copy()
+    rs = np.sum(r*r, axis=1)
+    for _ in xrange(iterations):
+        hp = hessp(p)
+        php = np.sum(p*hp, axis=1)
+        alpha = np.divide(rs, php, out=np.zeros_like(rs), where=php > 0)
+        x += alpha[:, np.newaxis]*p
+        r -= alpha[:, np.newaxis]*hp
+        rs_new = np.sum(r*r, axis=1)
+        if np.max(rs_new) < tol:
+            break
+        beta = np.divide(rs_new, rs, out=np.zeros_like(rs), where=rs > 0)
+        p = r + beta[:, np.newaxis]*p
+        rs = rs_new
+    return x
+
+
+def _solve_a_step_chunk(aux, idx_layer_aux, rows, params, options):
+    """ Solves the A-step of given rows of aux[idx_layer_aux] and writes
+    the result in place. Returns the rows' part of the penalised
+    objective. """
+
+    problem = AStepProblem.from_aux(aux, idx_layer_aux, rows, *params)
+    z = problem.solve_rows(aux[idx_layer_aux][rows], **options)
+    aux[idx_layer_aux][rows] = z
+    return problem.penalty(z)
+
+
+def _a_step_task(task):
+    """ Solves an A-step chunk in a worker of Mac's pool, writing the result
+    straight into the shared aux. """
+
+    return _solve_a_step_chunk(parallel.get_shared('aux'), *task)
+
+
+class InexactSchedule(object):
+    """ How exactly MAC solves its subproblems: loosely and with few
+    iterations while mu is small, as those solutions are soon thrown away,
+    tightening geometrically up to mu_final. Subproblems are never solved
+    much more exactly than the last relative change of the penalised error
+    (times forcing) warrants either. Either step starts from the previous
+    iterate, i.e. the current network or aux.
+
+    The tolerances are in the units of the solvers' own. That of
+    trust-krylov, L-BFGS-B and the batched A-step bounds the gradient
+    (gtol), whereas that of Newton-CG bounds the mean absolute update of a
+    variable (xtol), and so has a range of its own, starting from the fixed
+    ones MAC uses without a schedule. """
+
+    def __init__(self, mu_final=1e4,
+                 initial_tolerance=1e-1, final_tolerance=1e-5,
+                 initial_w_xtol=100, initial_a_xtol=1000, final_xtol=1e-2,
+                 initial_maxiter=5, final_maxiter=100,
+                 initial_gauss_newton=1, final_gauss_newton=10,
+                 forcing=0.1):
+        """ :param initial_tolerance: gtol while mu is 1
+        :param final_tolerance: gtol from mu_final on
+        :param initial_w_xtol: Newton-CG xtol of the W-step while mu is 1
+        :param initial_a_xtol: Newton-CG xtol of the joint A-step while mu
+            is 1
+        :param final_xtol: Newton-CG xtol of both steps from mu_final on
+        :param forcing: the tolerances are at most forcing times the last
+            relative change of the penalised error, relative to the gtol
+            range """
+
+        self.mu_final = mu_final
+        self.initial_tolerance = initial_tolerance
+        self.final_tolerance = final_tolerance
+        self.initial_xtol = {'w_step': initial_w_xtol,
+                             'a_step': initial_a_xtol}
+        self.final_xtol = final_xtol
+        self.initial_maxiter = initial_maxiter
+        self.final_maxiter = final_maxiter
+        self.initial_gauss_newton = initial_gauss_newton
+        self.final_gauss_newton = final_gauss_newton
+        self.forcing = forcing
+
+    def progress(self, mu):
+        """ Where mu is between 1 and mu_final on a log scale, from 0 to 1.
+        """
+
+        return min(1.0, max(0.0, math.log(mu) / math.log(self.mu_final)))
+
+    def interpolate(self, initial, final, mu):
+        """ Between initial and final for the given mu, on a log scale. """
+
+        return initial * (float(final) / initial)**self.progress(mu)
+
+    def tolerance(self, mu, change=None):
+        """ Tolerance (gtol) for the given mu and the last relative change
+        of the penalised error, if any. """
+
+        tolerance = self.interpolate(
+            self.initial_tolerance, self.final_tolerance, mu
+        )
+        if change is not None:
+            tolerance = min(tolerance, self.forcing * change)
+        return max(tolerance, self.final_tolerance)
+
+    def xtol(self, step, mu, change=None):
+        """ Newton-CG xtol of a step, 'w_step' or 'a_step', for the given
+        mu and the last relative change of the penalised error, if any,
+        tightened by forcing as much as the gtol is. """
+
+        xtol = self.interpolate(self.initial_xtol[step], self.final_xtol, mu)
+        if change is not None:
+            xtol *= self.tolerance(mu, change) / self.tolerance(mu)
+        return max(xtol, self.final_xtol)
+
+    def iterations(self, initial, final, mu):
+        return int(round(initial + (final - initial) * self.progress(mu)))
+
+    def solver_options(self, solver, mu, change=None, step='w_step'):
+        """ Options of a scipy.optimize solver for a step, 'w_step' or
+        'a_step'. """
+
+        options = {'maxiter': self.iterations(
+            self.initial_maxiter, self.final_maxiter, mu
+        )}
+        if solver == 'Newton-CG':
+            options['xtol'] = self.xtol(step, mu, change)
+        else:
+            options['gtol'] = self.tolerance(mu, change)
+        return options
+
+    def batched_options(self, mu, change=None):
+        """ Options of the batched A-step, see AStepProblem.solve_rows. """
+
+        tolerance = self.tolerance(mu, change)
+        return {'iterations': self.iterations(
+                    self.initial_gauss_newton, self.final_gauss_newton, mu),
+                'ftol': tolerance,
+                'tol': tolerance**2}
+
+
 class Mac(Trainer):
-    def __init__(self, network, training_data, validation_data):
+    W_STEP_MODES = ('serial', 'parallel')
+    A_STEP_MODES = ('joint', 'batched', 'parallel')
+
+    def __init__(self, network, training_data, validation_data,
+                 w_step_mode='serial', a_step_mode='joint', processes=None,
+                 units_per_task=50, a_step_chunk_size=1000,
+                 solver='Newton-CG', minibatch_size=None, minibatch_maxiter=5,
+                 tolerance=0.001, penalty_tolerance=0.1, mu_factor=10,
+                 max_iterations=20, checkpoint_dir=None,
+                 checkpoint_interval=1, schedule=None, aux_dir=None):
+        """ :param w_step_mode: 'serial' solves the W-step layer by layer,
+            'parallel' solves blocks of units of all layers at once in
+            a pool of processes sharing the aux
+        :param a_step_mode: 'joint' solves the A-step of a layer as one
+            Newton-CG problem over all samples, 'batched' solves it sample
+            by sample with vectorized updates over chunks of samples,
+            'parallel' does the same with the chunks spread over the pool
+        :param processes: size of the pool, defaults to the CPU count
+        :param units_per_task: output units per parallel subproblem
+        :param a_step_chunk_size: samples per batched A-step chunk
+        :param solver: scipy.optimize method of the W-step and the joint
+            A-step, one of Subproblem.SOLVERS. trust-krylov keeps a Lanczos
+            basis quadratic in the number of variables, so it is only
+            practical for the small subproblems of the parallel W-step
+        :param minibatch_size: if given, trains stochastically, i.e. every
+            iteration takes a W-step and an A-step per shuffled minibatch,
+            the latter updating only the aux of the minibatch
+        :param minibatch_maxiter: solver iterations of a minibatch W-step
+        :param tolerance: relative change of the nested error below which
+            training stops, once the penalised objective has converged
+        :param penalty_tolerance: relative change of the penalised
+            objective below which mu is increased by mu_factor
+        :param max_iterations: most MAC iterations to do regardless
+        :param checkpoint_dir: if given, the training state is snapshotted
+            there every checkpoint_interval iterations, see resume
+        :param schedule: an InexactSchedule to set the tolerances and
+            iteration caps of the subproblems by, instead of fixed ones
+        :param aux_dir: if given, the aux are kept in memory-mapped files
+            there instead of in memory, for data or networks too large
+            for it (the pool shares them all the same) """
+
+        if w_step_mode not in self.W_STEP_MODES:
+            raise ValueError("Unknown W-step mode: %s" % w_step_mode)
+        if a_step_mode not in self.A_STEP_MODES:
+            raise ValueError("Unknown A-step mode: %s" % a_step_mode)
+        if solver not in Subproblem.SOLVERS:
+            raise ValueError("Unknown solver: %s" % solver)
+        if not all(isinstance(L, Sigmoid) for L in network.layers[:-1]):
+            raise ValueError("MAC fits networks of Sigmoid hidden layers "
+                             "only.")
+
         self.network = network
         self.aux = None
+        self.augmented = None
         self.training_data = training_data
         self.validation_data = validation_data
-        self.evaluator = eva.Evaluator(self.training_data, self.validation_data)
+        # Training accuracy comes along with the nested error instead.
+        self.evaluator = eva.Evaluator(self.training_data, self.validation_data,
+                                       monitor_training_accuracy=False)
         self.mu = 1
+        self.tolerance = tolerance
+        self.penalty_tolerance = penalty_tolerance
+        self.mu_factor = mu_factor
+        self.max_iterations = max_iterations
+        self.penalised_error = None
+        self.nested_errors = []
+        self.penalised_errors = []
+        self.step = 0
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpointer = None
+        if checkpoint_dir is not None:
+            self.checkpointer = Checkpointer(checkpoint_dir)
+        self.solver = solver
+        self.w_step_mode = w_step_mode
+        self.w_step_options = {'disp': w_step_mode == 'serial'}
+        if solver == 'Newton-CG':
+            self.w_step_options['xtol'] = 100
+        self.a_step_mode = a_step_mode
+        if a_step_mode == 'joint':
+            self.a_step_options = {'disp': True}
+            if solver == 'Newton-CG':
+                self.a_step_options['xtol'] = 1000
+        else:
+            self.a_step_options = {'iterations': 5, 'cg_iterations': 10}
+        self.schedule = schedule
+        self.minibatch_size = minibatch_size
+        self.minibatch_maxiter = minibatch_maxiter
+        if minibatch_size is not None:
+            self.w_step_options.update(disp=False, maxiter=minibatch_maxiter)
+            if a_step_mode == 'joint':
+                self.a_step_options.update(disp=False)
+        # Solver iteration and evaluation counts of every step
+        self.stats = {'w_step': [], 'a_step': []}
+        self.processes = processes
+        self.units_per_task = units_per_task
+        self.a_step_chunk_size = a_step_chunk_size
+        self.aux_dir = aux_dir
+        self.pool = None
         super(Mac, self).__init__()
 
+    @classmethod
+    def resume(cls, checkpoint_dir, validation_data, **kwargs):
+        """ Returns a Mac (or one of its subclasses) restored from the
+        latest snapshot in a given directory, for train to carry on from
+        there. The training data is taken from the snapshot, kwargs are
+        passed on to the constructor. The global RNG is restored too, so
+        that minibatches are not shuffled as they were from the start. """
+
+        network, aux, state = Checkpointer.load(checkpoint_dir)
+        mac = cls(network, (aux[0], aux[-1]), validation_data, **kwargs)
+        mac.aux = aux
+        mac.step = state['step']
+        mac.mu = state['mu']
+        mac.nested_errors = state['nested_errors']
+        mac.penalised_errors = state['penalised_errors']
+        mac.stats = state['stats']
+        if 'random_state' in state:  # not in snapshots of older versions
+            name, keys, position, has_gauss, cached_gaussian = \
+                state['random_state']
+            np.random.set_state((name, np.array(keys, np.uint32), position,
+                                 has_gauss, cached_gaussian))
+        mac.checkpointer = Checkpointer(checkpoint_dir, data_written=True)
+        return mac
+
+    def checkpoint(self):
+        """ Snapshots the training state in the background. """
+
+        name, keys, position, has_gauss, cached_gaussian = \
+            np.random.get_state()
+        self.checkpointer.save(self.network, self.aux, {
+            'step': self.step,
+            'mu': self.mu,
+            'nested_errors': [float(e) for e in self.nested_errors],
+            'penalised_errors': [float(e) for e in self.penalised_errors],
+            'stats': dict(
+                (step, [dict((key, int(count)) for key, count in s.items())
+                        for s in step_stats])
+                for step, step_stats in self.stats.items()
+            ),
+            'random_state': [name, keys.tolist(), int(position),
+                             int(has_gauss), float(cached_gaussian)]
+        })
+
     def pretrain(self):
         scheduler = ListScheduler(max_epochs=1)
         Sgd().sgd(self.network, self.training_data, scheduler=scheduler)
 
-    def w_step(self):
-        def w_top_jac(params_flat):
-            w = params_flat.reshape(params.shape)
-
-            fkminus1 = layer.feed_forward(self.aux[idx_layer], w)
-            de_dak = fkminus1 - self.aux[idx_layer+1]
-
-            return np.ndarray.flatten(np.append(np.dot(
-                self.aux[idx_layer].T, de_dak), [np.sum(de_dak, axis=0)]))
-
-        def w_hidden_jac(params_flat):
-            w = params_flat.reshape(params.shape)
-
-            fkminus1 = layer.feed_forward(self.aux[idx_layer], w)
-            de_dfk = (fkminus1-self.aux[idx_layer+1]) * (fkminus1*(1-fkminus1))
-
-            return np.ndarray.flatten(np.append(np.dot(
-                self.aux[idx_layer].T, de_dfk), [np.sum(de_dfk, axis=0)]))
+    def w_step(self, rows=slice(None)):
+        """ Fits the network to the aux, or to the given rows of it only.
+        Returns the solver counts. """
 
-        def w_cost(params_flat):
-            w = params_flat.reshape(params.shape)
-
-            returnable = np.sum((
-                self.aux[idx_layer+1] - layer.feed_forward(self.aux[idx_layer],
-                                                           w)
-            )**2)
-            log.debug("Returnable w_step_f: %s", returnable)
-            return returnable
+        stats = solver_stats()
+        if self.w_step_mode == 'parallel':
+            self._parallel_w_step(rows, stats)
+        else:
+            self._serial_w_step(rows, stats)
+        return stats
 
+    def _serial_w_step(self, rows, stats):
         log.debug("Start enumerating through layers...")
         for idx_layer, layer in reversed(list(enumerate(self.network.layers))):
             log.debug("At layer number %d with shape %s",
                       idx_layer, layer.weights.shape)
 
-            if idx_layer == len(self.network.layers) - 1:
-                jac = w_top_jac
-            else:
-                jac = w_hidden_jac
-
-            params = np.append(layer.weights, [layer.biases], axis=0)
+            problem = WStepProblem(
+                self.augmented[idx_layer][rows], self.aux[idx_layer+1][rows],
+                top=idx_layer == len(self.network.layers) - 1,
+                direct=self.minibatch_size is None
+            )
+            params = self.network.layer_params(idx_layer)
 
             log.debug("Start minimizing W step function...")
-            res = minimize(w_cost, params,
-                           method='Newton-CG',
-                           jac=jac,
-                           options={'disp': True, 'xtol': 100})
+            optimised_params, layer_stats = problem.minimize(
+                params, self.w_step_options, self.solver
+            )
+            add_stats(stats, layer_stats)
             log.debug("W step function minimized.")
 
-            optimised_params = res.x.reshape(params.shape)
-            self.network.layers[idx_layer].weights = optimised_params[:-1]
-            self.network.layers[idx_layer].biases = optimised_params[-1]
+            params[...] = optimised_params
 
             log.debug("Updated network with optimized weights.")
 
-    def a_step(self):
-        def aux_top_jac(aux_flat):
-            layer_aux = aux_flat.reshape(aux_shape)
-
-            return np.ndarray.flatten(np.dot(
-                layer.feed_forward(layer_aux) - self.aux[idx_layer_aux+1],
-                layer.weights.T))
-
-        def aux_hidden_jac(aux_flat):
-            layer_aux = aux_flat.reshape(aux_shape)
-
-            fk = layer.feed_forward(layer_aux)
-
-            return np.ndarray.flatten(np.dot(
-                (fk-self.aux[idx_layer_aux+1]) * (fk*(1-fk)), layer.weights.T))
-
-        def aux_cost(aux_flat):
-            layer_aux = aux_flat.reshape(aux_shape)
-
-            returnable = np.sum((
-                0.5 * (1 if idx_layer_aux is len(self.aux)-2 else self.mu) * (
-                    self.aux[idx_layer_aux+1] - layer.feed_forward(layer_aux))
-            )**2)
-            log.debug("Returnable a_step_f: %s", returnable)
-            return returnable
-
-        for idx_layer_aux, layer_aux in enumerate(self.aux):
-            if idx_layer_aux not in [0, len(self.aux) - 1]:
-                log.debug("At layer number %d with shape %s",
-                          idx_layer_aux, layer_aux.shape)
-
-                aux_shape = np.shape(layer_aux)
-                layer = self.network.layers[idx_layer_aux]
-
-                if idx_layer_aux == len(self.aux) - 2:
-                    jac = aux_top_jac
-                else:
-                    jac = aux_hidden_jac
-
+    def _parallel_w_step(self, rows, stats):
+        """ Solves the W-step as independent subproblems, one per block of
+        units_per_task output units of every layer, in the process pool.
+        A directly solved top layer is a single subproblem though, as its
+        Gram matrix is shared by all its units. The workers read the aux
+        from shared memory. """
+
+        top = len(self.network.layers) - 1
+        direct = self.minibatch_size is None
+        tasks = []
+        for idx_layer in xrange(len(self.network.layers)):
+            params = self.network.layer_params(idx_layer)
+            units_per_task = self.units_per_task
+            if idx_layer == top and direct:
+                units_per_task = params.shape[1]
+            for start in xrange(0, params.shape[1], units_per_task):
+                stop = min(start + units_per_task, params.shape[1])
+                tasks.append((idx_layer, rows, start, stop,
+                              params[:, start:stop], idx_layer == top,
+                              direct, self.w_step_options, self.solver))
+
+        log.debug("Solving %d W step subproblems in parallel...", len(tasks))
+        results = self.pool.map(_w_step_task, tasks)
+        for _, task_stats in results:
+            add_stats(stats, task_stats)
+
+        for idx_layer in xrange(len(self.network.layers)):
+            self.network.layer_params(idx_layer)[...] = np.concatenate([
+                result for task, (result, _) in zip(tasks, results)
+                if task[0] == idx_layer
+            ], axis=1)
+
+        log.debug("Updated network with optimized weights.")
+
+    def a_step(self, rows=slice(None)):
+        """ Fits the aux to the network, or the given rows of it only, and
+        keeps the rows' part of the penalised objective as penalised_error.
+        Returns the solver counts of a joint A-step, None otherwise. """
+
+        stats = solver_stats()
+        self.penalised_error = 0.0
+        for idx_layer_aux in xrange(1, len(self.aux) - 1):
+            log.debug("At layer number %d with shape %s",
+                      idx_layer_aux, self.aux[idx_layer_aux].shape)
+
+            lower = self.network.layers[idx_layer_aux - 1]
+            upper = self.network.layers[idx_layer_aux]
+            top = idx_layer_aux == len(self.aux) - 2
+            params = (lower.weights, lower.biases,
+                      upper.weights, upper.biases,
+                      self.mu, 1 if top else self.mu, top)
+
+            if self.a_step_mode == 'joint':
+                problem = AStepProblem.from_aux(
+                    self.aux, idx_layer_aux, rows, *params
+                )
                 log.debug("Start minimizing A step cost function...")
-                res = minimize(aux_cost, layer_aux,
-                               method='Newton-CG',
-                               jac=jac,
-                               options={'disp': True, 'xtol': 1000})
+                optimised_aux, layer_stats = problem.minimize(
+                    self.aux[idx_layer_aux][rows], self.a_step_options,
+                    self.solver
+                )
+                self.aux[idx_layer_aux][rows] = optimised_aux
+                self.penalised_error += problem.penalty(optimised_aux)
+                add_stats(stats, layer_stats)
                 log.debug("A step cost function minimized. ")
+                continue
+
+            tasks = [
+                (idx_layer_aux, chunk, params, self.a_step_options)
+                for chunk in self._chunks(rows)
+            ]
+            log.debug("Solving A step in %d chunks of samples...", len(tasks))
+            if self.a_step_mode == 'parallel':
+                penalties = self.pool.map(_a_step_task, tasks)
+            else:
+                penalties = [
+                    _solve_a_step_chunk(self.aux, *task) for task in tasks
+                ]
+            self.penalised_error += sum(penalties)
+
+            log.debug("Updated aux by optimized aux.")
+
+        if self.a_step_mode == 'joint':
+            return stats
+
+    def _chunks(self, rows):
+        """ Splits rows of the aux, all of them or given indices, into
+        chunks of at most a_step_chunk_size rows. """
+
+        if isinstance(rows, slice):
+            return [
+                slice(start, start + self.a_step_chunk_size)
+                for start in xrange(0, len(self.aux[0]), self.a_step_chunk_size)
+            ]
+        return [
+            rows[start:start + self.a_step_chunk_size]
+            for start in xrange(0, len(rows), self.a_step_chunk_size)
+        ]
+
+    def stochastic_step(self):
+        """ Takes a W-step and an A-step on every minibatch of a random
+        permutation of the samples. Returns the summed solver counts. """
+
+        w_stats = solver_stats()
+        a_stats = solver_stats() if self.a_step_mode == 'joint' else None
+        penalised_error = 0.0
+        for rows in Utils.minibatch_indices(len(self.aux[0]),
+                                            self.minibatch_size):
+            # Sorted rows gather from the aux in memory order.
+            rows.sort()
+            add_stats(w_stats, self.w_step(rows))
+            minibatch_a_stats = self.a_step(rows)
+            penalised_error += self.penalised_error
+            if a_stats is not None:
+                add_stats(a_stats, minibatch_a_stats)
+        # Only approximate, as the network changes between minibatches.
+        self.penalised_error = penalised_error
+        return w_stats, a_stats
+
+    def apply_schedule(self, change=None):
+        """ Sets the solvers' tolerances and iteration caps by the schedule
+        for the current mu and the last relative change of the penalised
+        error. """
+
+        if self.schedule is None:
+            return
+        options = self.schedule.solver_options(self.solver, self.mu, change)
+        self.w_step_options.update(options)
+        if self.minibatch_size is not None:
+            self.w_step_options['maxiter'] = \
+                min(options['maxiter'], self.minibatch_maxiter)
+        if self.a_step_mode == 'joint':
+            self.a_step_options.update(self.schedule.solver_options(
+                self.solver, self.mu, change, step='a_step'
+            ))
+        else:
+            self.a_step_options.update(
+                self.schedule.batched_options(self.mu, change)
+            )
+        log.debug("Solving W-step with %s, A-step with %s.",
+                  self.w_step_options, self.a_step_options)
+
+    def record_stats(self, step, stats):
+        if stats is not None:
+            self.stats[step].append(stats)
+            log.info("%s solver counts: %s", step, stats)
+
+    def postprocessing_step(self, feats, labels, minibatch_size=64,
+                            learning_rate=0.1):
+        """ Trains the top layer alone, as a softmax regression on the
+        penultimate activations. The layers below are fixed meanwhile, so
+        those activations are computed only once. """
+
+        features = feats
+        for L in self.network.layers[:-1]:
+            features = L.feed_forward(features)
+        top = self.network.layers[-1]
+        eta = learning_rate / minibatch_size
 
-                self.aux[idx_layer_aux] = res.x.reshape(aux_shape)
-                log.debug("Updated aux by optimized aux.")
-
-    def postprocessing_step(self, feats, labels):
         prev_scalar_cost = sys.maxint
         while True:
-            activations = self.network.feed_forward(feats, return_all=True)
-            scalar_cost = self.cost.fn(activations[-1], labels)
+            linear_activations = top.linear_activations(features)
+            scalar_cost, _ = self.cost.softmax_fn_delta(
+                linear_activations, labels, linear_activations
+            )
             log.info("scalar_cost %f", scalar_cost)
             if abs(prev_scalar_cost - scalar_cost) < 0.001:
                 break
-            minibatch_size = 64
-            feats, labels = Utils.shuffle_in_unison(feats, labels)
-            feats_split = np.array_split(feats, len(feats) / minibatch_size)
-            labels_split = np.array_split(labels, len(labels) / minibatch_size)
-            eta = 0.1 / minibatch_size
-            for mini_feats, mini_labels in zip(feats_split, labels_split):
-                mini_activations = self.network.feed_forward(
-                    mini_feats, return_all=True)
-                error = self.cost.delta(mini_activations[-1], mini_labels)
-                self.network.layers[-1].biases -= eta * np.sum(error, axis=0)
-                self.network.layers[-1].weights -= eta * np.dot(
-                    mini_activations[-2].T, error)
+            for mini_features, mini_labels in \
+                    Minibatches((features, labels), minibatch_size):
+                linear_activations = top.linear_activations(mini_features)
+                _, error = self.cost.softmax_fn_delta(
+                    linear_activations, mini_labels, linear_activations
+                )
+                top.biases -= eta * np.sum(error, axis=0)
+                top.weights -= eta * np.dot(mini_features.T, error)
             prev_scalar_cost = scalar_cost
 
+    def initialise_aux(self, feats, labels):
+        """ Sets the aux to the activations of the current network, unless
+        they were resumed, and starts the process pool if one is needed.
+        The activations are computed chunk by chunk right into the aux. """
+
+        # Workers are forked after this, so they share the aux with us
+        # as long as it is only ever updated in place.
+        share = 'parallel' in (self.w_step_mode, self.a_step_mode)
+        dtype = self.network.dtype
+
+        # The input of every layer is kept with a column of ones appended,
+        # which is what the W-step works on, the aux being views of it.
+        # All of them are kept in the network's dtype.
+        resumed = self.aux
+        widths = [feats.shape[1]] + \
+            [L.weights.shape[1] for L in self.network.layers[:-1]]
+        self.augmented = [
+            self.allocate_aux('aux_%d' % idx, (len(feats), width + 1), dtype,
+                              share)
+            for idx, width in enumerate(widths)
+        ]
+        for augmented in self.augmented:
+            augmented[:, -1] = 1.0
+        self.aux = [augmented[:, :-1] for augmented in self.augmented]
+        if resumed is None:
+            log.debug("Initialising aux...")
+            self.aux[0][...] = feats
+            self.network.feed_forward_into(feats, self.aux[1:])
+        else:
+            for a, resumed_a in zip(self.aux, resumed[:-1]):
+                a[...] = resumed_a
+            labels = resumed[-1]
+        labels = np.asarray(labels, dtype)
+        self.aux.append(parallel.shared_copy(labels) if share else labels)
+
+        if share:
+            self.pool = parallel.SharedPool(
+                {'aux': self.aux, 'augmented': self.augmented},
+                processes=self.processes
+            )
+        log.debug("aux initialized.")
+
+    def allocate_aux(self, name, shape, dtype, share):
+        """ Allocates an array of the aux, in a memory-mapped file named
+        after it in aux_dir if given, else in shared memory if the pool is
+        to share it. """
+
+        if self.aux_dir is not None:
+            if not os.path.isdir(self.aux_dir):
+                os.makedirs(self.aux_dir)
+            return np.lib.format.open_memmap(
+                os.path.join(self.aux_dir, name + '.npy'), mode='w+',
+                dtype=dtype, shape=shape
+            )
+        if share:
+            return parallel.shared_array(shape, dtype)
+        return np.empty(shape, dtype)
+
+    def release(self):
+        """ Stops the process pool, if any. """
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def nested_error(self, chunk_size=5000):
+        """ Computes the nested error, i.e. the error of the network with its
+        top layer linear as MAC fits it, on the training data. The same
+        single pass yields the training cost and accuracy of the network,
+        which are logged along. """
+
+        feats, labels = self.training_data
+        top = self.network.layers[-1]
+        nested_error = 0.0
+        training_cost = 0.0
+        training_accuracy = 0
+        for start in xrange(0, len(feats), chunk_size):
+            activations = feats[start:start + chunk_size]
+            mini_labels = labels[start:start + chunk_size]
+            for L in self.network.layers[:-1]:
+                activations = L.feed_forward(activations)
+            linear_activations = top.linear_activations(activations)
+
+            nested_error += 0.5*np.sum((mini_labels - linear_activations)**2)
+            training_accuracy += np.sum(np.equal(
+                np.argmax(linear_activations, axis=1),
+                np.argmax(mini_labels, axis=1)
+            ))
+            scalar_cost, _ = self.cost.softmax_fn_delta(
+                linear_activations, mini_labels, linear_activations
+            )
+            training_cost += scalar_cost * len(mini_labels)
+
+        log.info("Nested error: \t%f", nested_error)
+        log.info("Training cost: \t%f", training_cost / len(feats))
+        log.info("Training accuracy: \t%d / %d", training_accuracy, len(feats))
+        self.evaluator.training_errors.append(
+            Utils.error_fraction(training_accuracy, len(feats))
+        )
+        return nested_error
+
     def log_all(self):
-        log.info("Training cost: \t%d", self.evaluator.total_cost(
-            self.cost, self.training_data, self.network))
+        """ Logs the training and validation performance. Returns the
+        nested error. """
+
+        nested_error = self.nested_error()
         self.evaluator.monitor(self.network)
+        return nested_error
 
     def train(self):
         """ Does method of auxiliary coordinates (MAC) training on a given
         network and training data. """
 
         feats, labels = self.training_data
-        feats, labels = Utils.shuffle_in_unison(feats, labels)
+        if self.aux is None:
+            # The aux keep to this order from now on.
+            feats, labels = Utils.shuffle_in_unison(feats, labels)
 
         log.info("Starting MAC training with...")
         log.info("Feats \t%s", feats.shape)
@@ -185,42 +973,77 @@ class Mac(Trainer):
         # self.pretrain()
         # log.debug("Pretraining done.")
 
-        self.log_all()
-
-        log.debug("Initialising aux...")
-        self.aux = self.network.feed_forward(feats, return_all=True)
-        self.aux[-1] = labels
-        log.debug("aux initialized.")
-
-        tolerance = 0.01  # nested error threshold
-        nested_error_change = sys.maxint
-        step = 0
-
-        while nested_error_change > tolerance:
-            step += 1
-
-            log.info("Starting W-step...")
-            self.w_step()
-            log.info("W-step complete.")
-
-            # log.debug("Forcing garbage collection...")
-            gc.collect()
-
-            log.info("Starting A-step...")
-            self.a_step()
-            log.info("A-step complete.")
-
-            # log.debug("Forcing garbage collection...")
-            gc.collect()
-
-            self.mu *= 10
+        if self.aux is None:
+            nested_error = self.log_all()
+            # The aux are the activations at first, so no penalty is paid.
+            penalised_error = nested_error
+        else:
+            log.info("Resuming from iteration %d.", self.step)
+            nested_error = self.nested_errors[-1]
+            penalised_error = self.penalised_errors[-1]
+
+        self.initialise_aux(feats, labels)
+        penalised_error_change = None
+
+        try:
+            while self.step < self.max_iterations:
+                self.step += 1
+                self.apply_schedule(penalised_error_change)
+
+                if self.minibatch_size is None:
+                    log.info("Starting W-step...")
+                    self.record_stats('w_step', self.w_step())
+                    log.info("W-step complete.")
+
+                    # log.debug("Forcing garbage collection...")
+                    gc.collect()
+
+                    log.info("Starting A-step...")
+                    self.record_stats('a_step', self.a_step())
+                    log.info("A-step complete.")
+                else:
+                    log.info("Starting minibatch W- and A-steps...")
+                    w_stats, a_stats = self.stochastic_step()
+                    self.record_stats('w_step', w_stats)
+                    self.record_stats('a_step', a_stats)
+                    log.info("Minibatch W- and A-steps complete.")
 
-            log.info("Quadratic penalty increased. New QP: %d", self.mu)
+                # log.debug("Forcing garbage collection...")
+                gc.collect()
 
-            self.log_all()
+                penalised_error_change = Utils.relative_change(
+                    penalised_error, self.penalised_error
+                )
+                penalised_error = self.penalised_error
+                log.info("Penalised error: \t%f (change %f)",
+                         penalised_error, penalised_error_change)
 
-            # TODO: compute nested_error_change
-            nested_error_change -= sys.maxint/2
+                new_nested_error = self.log_all()
+                nested_error_change = Utils.relative_change(
+                    nested_error, new_nested_error
+                )
+                nested_error = new_nested_error
+                self.nested_errors.append(nested_error)
+                self.penalised_errors.append(penalised_error)
+
+                # Stalling on loose subproblem solves is no convergence.
+                if penalised_error_change < self.penalty_tolerance:
+                    if nested_error_change < self.tolerance and (
+                            self.schedule is None or
+                            self.schedule.progress(self.mu) >= 1):
+                        log.info("Nested error converged.")
+                        break
+                    self.mu *= self.mu_factor
+                    log.info("Quadratic penalty increased. New QP: %d",
+                             self.mu)
+
+                if self.checkpointer is not None and \
+                        self.step % self.checkpoint_interval == 0:
+                    self.checkpoint()
+        finally:
+            if self.checkpointer is not None:
+                self.checkpointer.wait()
+            self.release()
 
         log.info("Starting post-processing...")
         self.postprocessing_step(feats, labels)
@@ -229,54 +1052,176 @@ class Mac(Trainer):
         self.log_all()
 
 
-class Sgd(Trainer):
-    def __init__(self):
-        super(Sgd, self).__init__()
-
-    def sgd(self, network, training_data, minibatch_size=10,
-            momentum=0.5, evaluator=None, scheduler=None):
-        """ Does stochastic gradient descent training on a given
-        network and training data for a number of epochs (times). """
-
-        def update(xs, ys, speeds):
-            """ The core of sgd given features xs and their respective
-            labels ys. """
-
-            # Generate predictions given current params.
-            activations = network.feed_forward(xs, return_all=True)
+class SgdWorkspace(object):
+    """ Everything SGD on a given network computes per minibatch of up to a
+    given size, allocated once: activations, deltas, backpropagated errors,
+    gradients and momentum velocities. step trains the network on a
+    minibatch in place, with no allocations of the minibatch's size.
+    A delta and an error are only kept for one layer at a time, and with
+    checkpoint_every only the activations of every so many layers are kept
+    through the backward pass, the others being computed again. """
+
+    def __init__(self, network, minibatch_size, cost=CrossEntropyCost,
+                 gradients=None, checkpoint_every=None):
+        """ :param gradients: flat array to keep the gradients in, e.g. in
+            shared memory, laid out as by param_views; by default that of
+            the network
+        :param checkpoint_every: if given, k such that only the
+            activations of every kth layer (and of the top one) are kept,
+            the layers in between sharing k-1 buffers. That is about
+            sqrt(N) buffers for N layers with k = sqrt(N), for the price of
+            about one more feed forward per minibatch """
+
+        if checkpoint_every is not None and (
+                not isinstance(checkpoint_every, (int, long)) or
+                checkpoint_every < 1):
+            raise ValueError("checkpoint_every has to be None or a positive "
+                             "integer, not %r" % (checkpoint_every,))
 
-            # Compute the top level error and cost for minibatch.
-            cost_gradient = self.cost.delta(activations[-1], ys)
+        self.network = network
+        self.minibatch_size = minibatch_size
+        self.cost = cost
+        layers = network.layers
+        self.dtype = network.dtype
+        self.widths = [L.weights.shape[1] for L in layers]
+        top = len(layers) - 1
+        k = self.checkpoint_every = checkpoint_every
+        self.checkpoints = [k is None or (idx + 1) % k == 0 or idx == top
+                            for idx in xrange(len(layers))]
+        # The layers of the segment written last in the feed forward need
+        # not be computed again. It starts at the last multiple of k below
+        # the top, the top itself being a checkpoint.
+        self.top_segment = 0
+        if k is not None:
+            self.top_segment = top - top % k
+            if top % k == 0:
+                self.top_segment -= k
+
+        # Flat buffers, of which the first rows*width elements are viewed
+        # as a contiguous matrix of a minibatch's rows.
+        shared = {}
+        for idx, width in enumerate(self.widths):
+            if not self.checkpoints[idx]:
+                shared[idx % k] = max(shared.get(idx % k, 0), width)
+        shared = dict((slot, np.empty(minibatch_size * width, self.dtype))
+                      for slot, width in shared.items())
+        self.activations = [
+            np.empty(minibatch_size * width, self.dtype)
+            if self.checkpoints[idx] else shared[idx % k]
+            for idx, width in enumerate(self.widths)
+        ]
+        widest = max(max(L.weights.shape) for L in layers)
+        self.delta = np.empty(minibatch_size * widest, self.dtype)
+        # Errors w.r.t. the activations of a layer and of the one below,
+        # in turns.
+        self.errors = [np.empty(minibatch_size * widest, self.dtype)
+                       for _ in xrange(2)]
+
+        if gradients is None:
+            gradients = network.gradients
+        self.nabla = gradients
+        self.nabla_w, self.nabla_b = param_views(gradients, network)
+        self.velocity = np.zeros(param_count(network), self.dtype)
+        # A softmax top layer's cost and delta are computed at once from
+        # its linear activations, if the cost can.
+        self.fused = isinstance(layers[-1], Softmax) and \
+            hasattr(cost, 'softmax_fn_delta')
+
+    def reset_velocities(self):
+        self.velocity.fill(0.0)
+
+    def step(self, xs, ys, learning_rate, momentum):
+        """ Does a momentum SGD update on features xs and their respective
+        labels ys. Returns the minibatch's cost. """
+
+        scalar_cost = self.gradients(xs, ys)
+        self.update(learning_rate, momentum, len(xs))
+        return scalar_cost
+
+    def gradients(self, xs, ys):
+        """ Computes the gradients of the cost summed over features xs and
+        their respective labels ys into nabla_w and nabla_b. Returns the
+        minibatch's cost. """
+
+        rows = len(xs)
+        xs = np.asarray(xs, self.dtype)
+        layers = self.network.layers
+        top = len(layers) - 1
+        activations = [buffer[:rows * width].reshape(rows, width)
+                       for buffer, width in zip(self.activations, self.widths)]
+
+        inputs = xs
+        for L, activation in zip(layers[:-1], activations):
+            inputs = L.feed_forward(inputs, out=activation)
+        error = self.errors[top % 2][:rows * self.widths[top]] \
+            .reshape(rows, self.widths[top])
+        if self.fused:
+            layers[-1].linear_activations(inputs, out=activations[-1])
+            scalar_cost, error = self.cost.softmax_fn_delta(
+                activations[-1], ys, out=error
+            )
+        else:
+            layers[-1].feed_forward(inputs, out=activations[-1])
             scalar_cost = self.cost.fn(activations[-1], ys)
+            error = self.cost.delta(activations[-1], ys, out=error)
+
+        for idx in xrange(top, -1, -1):
+            if self.checkpoints[idx] and idx < self.top_segment:
+                # Computes the activations below, up to the last checkpoint
+                # again, the buffers having been reused by the layers above.
+                for below in xrange(idx - self.checkpoint_every + 1, idx):
+                    layers[below].feed_forward(
+                        xs if below == 0 else activations[below-1],
+                        out=activations[below]
+                    )
+            delta = layers[idx].delta(
+                error, activations[idx],
+                out=self.delta[:rows * self.widths[idx]]
+                .reshape(rows, self.widths[idx])
+            )
+            inputs = xs if idx == 0 else activations[idx-1]
+            np.dot(inputs.T, delta, out=self.nabla_w[idx])
+            np.sum(delta, axis=0, out=self.nabla_b[idx])
+            if idx > 0:
+                error = np.dot(
+                    delta, layers[idx].weights.T,
+                    out=self.errors[(idx - 1) % 2][:rows * self.widths[idx-1]]
+                    .reshape(rows, self.widths[idx-1])
+                )
+        return scalar_cost
 
-            # Backpropagate the errors, compute deltas.
-            deltas = network.feed_backward(cost_gradient, activations)
+    def update(self, learning_rate, momentum, rows):
+        """ Does a momentum step along nabla, the gradients summed over a
+        minibatch of a given number of rows, on the flat params of the
+        network. nabla is overwritten in the process. """
 
-            # Given both passes, compute actual gradients w.r.t params.
-            nabla_b = np.empty(len(network.layers), dtype=object)
-            nabla_w = np.empty(len(network.layers), dtype=object)
+        # Sum over the minibatch, compensated in the learning rate.
+        self.velocity *= momentum
+        self.nabla *= learning_rate/rows
+        self.velocity -= self.nabla
+        self.network.params += self.velocity
 
-            # Compute the sum over minibatch, and compensate in
-            # learning rate scaling it down by mini-batch size.
-            for idx in xrange(0, len(network.layers)):
-                nabla_b[idx] = np.sum(deltas[idx], axis=0)
-                nabla_w[idx] = np.dot(activations[idx].T, deltas[idx])
-            learning_rate_scaled = learning_rate/len(xs)
 
-            # Update momentum layers
-            for idx, speed in enumerate(speeds):
-                speed[0] = \
-                    momentum*speed[0] - learning_rate_scaled*nabla_w[idx]
-                speed[1] = \
-                    momentum*speed[1] - learning_rate_scaled*nabla_b[idx]
+class Sgd(Trainer):
+    def __init__(self, checkpoint_every=None):
+        """ :param checkpoint_every: see SgdWorkspace, to keep fewer
+            activations in memory """
 
-            # Update weights and biases.
-            for idx, (layer, speed) in \
-                    enumerate(zip(network.layers, speeds)):
-                layer.weights += speed[0]
-                layer.biases += speed[1]
+        super(Sgd, self).__init__()
+        self.checkpoint_every = checkpoint_every
+        self.network = None
+        self.training_data = None
+        self.minibatch_size = None
+        self.momentum = None
+        self.workspace = None
+        self.minibatches = None
 
-            return scalar_cost, speeds
+    def sgd(self, network, training_data, minibatch_size=10,
+            momentum=0.5, evaluator=None, scheduler=None):
+        """ Does stochastic gradient descent training on a given
+        network and training data for a number of epochs (times). If the
+        scheduler keeps the most accurate params (DecayScheduler), those
+        are what the network is left with. """
 
         if scheduler is None:
             scheduler = ListScheduler()
@@ -285,42 +1230,41 @@ class Sgd(Trainer):
         log.info("Starting SGD training with...")
         log.info("Feats \t%s", feats.shape)
         log.info("Labels \t%s", labels.shape)
-
-        learning_rate = scheduler.get_learning_rate()
-        while learning_rate > 0:
-            log.info("Epoch \t%d", scheduler.epoch)
-
-            # Prepare training data
-            feats, labels = Utils.shuffle_in_unison(feats, labels)
-            feats_split = np.split(feats, len(feats)/minibatch_size)
-            labels_split = np.split(labels, len(labels)/minibatch_size)
-
-            # Initialize speed layers (which are updated via momentum)
-            speed_layers = np.asarray([
-                (np.zeros_like(L.weights), np.zeros_like(L.biases))
-                for L in network.layers
-            ])
-
-            # Descend the gradient
-            training_cost = 0.0
-            for mini_feats, mini_labels in zip(feats_split, labels_split):
-                scalar_cost, speed_layers = update(
-                    mini_feats, mini_labels, speed_layers
-                )
-                training_cost += scalar_cost
+        self.start(network, training_data, int(minibatch_size), momentum)
+
+        try:
+            learning_rate = scheduler.get_learning_rate()
+            while learning_rate > 0:
+                log.info("Epoch \t%d", scheduler.epoch)
+
+                # Descend the gradient
+                training_cost = 0.0
+                started = time.time()
+                for scalar_cost in self.train_epoch(learning_rate):
+                    training_cost += scalar_cost
+                    if evaluator is not None:
+                        evaluator.log_training_costs(training_cost)
+                log.info("Trained on %.0f samples/s.",
+                         len(feats) / (time.time() - started))
+
+                # Network evaluation and learning rate scheduling
+                accuracy, evaluated = None, network
                 if evaluator is not None:
-                    evaluator.log_training_costs(training_cost)
+                    accuracy = evaluator.monitor(network)
+                    evaluated = evaluator.network
+                if scheduler is not None:
+                    scheduler.compute_next_learning_rate(accuracy, evaluated)
+                    learning_rate = scheduler.get_learning_rate()
 
-            # Network evaluation and learning rate scheduling
-            accuracy = None
+            # Results of an asynchronous evaluator may still be coming.
             if evaluator is not None:
-                accuracy = evaluator.monitor(network)
-            if scheduler is not None:
-                scheduler.compute_next_learning_rate(accuracy, network)
-                learning_rate = scheduler.get_learning_rate()
+                for accuracy, evaluated in evaluator.finish():
+                    scheduler.compute_next_learning_rate(accuracy, evaluated)
+        finally:
+            self.finish()
 
-        if hasattr(scheduler, 'highest_accuracy_network'):
-            network = scheduler.highest_accuracy_network
+        if getattr(scheduler, 'snapshot', None) is not None:
+            scheduler.snapshot.restore(network)
             log.info(
                 "Learning stopped. Highest accuracy: %d",
                 scheduler.highest_accuracy
@@ -329,3 +1273,32 @@ class Sgd(Trainer):
         # For plotting use
         if evaluator is not None:
             return evaluator.validation_errors, evaluator.training_costs
+
+    def start(self, network, training_data, minibatch_size, momentum):
+        """ Prepares training a network on given data. """
+
+        self.network = network
+        self.training_data = training_data
+        self.minibatch_size = minibatch_size
+        self.momentum = momentum
+        self.workspace = SgdWorkspace(network, minibatch_size, self.cost,
+                                      checkpoint_every=self.checkpoint_every)
+        self.minibatches = Minibatches(training_data, minibatch_size)
+
+    def train_epoch(self, learning_rate):
+        """ Trains the network on a shuffle of all the training data.
+        Yields the cost of every minibatch. """
+
+        # Reset speeds (which are updated via momentum)
+        self.workspace.reset_velocities()
+
+        for mini_feats, mini_labels in self.minibatches:
+            yield self.workspace.step(
+                mini_feats, mini_labels, learning_rate, self.momentum
+            )
+
+    def finish(self):
+        """ Releases whatever start acquired. """
+
+        self.workspace = None
+        self.minibatches = None
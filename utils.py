@@ -24,13 +24,13 @@ class Utils(object):
         return vectorized_digit
 
     @staticmethod
-    def vectorize_digits(digits):
+    def vectorize_digits(digits, dtype=np.float64):
         """ Return a len(digits)x10-dimensional one-hot vector with a
         1.0 in the ith position and zeroes elsewhere.  This is used to
         convert a digit into a corresponding desired output from the
         neural network. """
 
-        vectorized_digits = np.zeros((len(digits), 10))
+        vectorized_digits = np.zeros((len(digits), 10), dtype)
         for idx, digit in enumerate(digits):
             vectorized_digits[idx][digit] = 1.0
         return vectorized_digits
@@ -47,36 +47,34 @@ class Utils(object):
         np.random.shuffle(labels)
         return feats, labels
 
-    # Broken, don't use.
     @staticmethod
-    def shuffle_in_unison_with_aux(feats, labels, aux_layers):
-        """ Shuffles feats and labels on the first axis such that the
-        change in ordering is identical in both. Equal length arrays
-        assumed. The same is performed on auxiliary coordinates
-        on every layer. """
+    def minibatch_indices(length, minibatch_size):
+        """ Splits a random permutation of range(length) into minibatches
+        of indices, the last one possibly smaller. Indexing feats, labels
+        and the auxiliary coordinates of every layer with the same
+        minibatch shuffles them in unison, without moving any of them
+        around in memory. """
 
-        rng_state = np.random.get_state()
-        np.random.shuffle(feats)
-        np.random.set_state(rng_state)
-        np.random.shuffle(labels)
-        for layer in aux_layers:
-            np.random.set_state(rng_state)
-            np.random.shuffle(layer)
-        return feats, labels, aux_layers
+        permutation = np.random.permutation(length)
+        return [permutation[start:start + minibatch_size]
+                for start in xrange(0, length, minibatch_size)]
 
     @staticmethod
-    def softmax(v):
-        """ Classic implementation of the Softmax algorithm. """
-
-        # log.debug("Using softmax with input: %s shape: %s", v, np.shape(v))
-        exp_v = np.exp(v)
-        # log.debug("Exp: %s shape: %s", exp_v, np.shape(exp_v))
-        if len(np.shape(exp_v)) is 1:
-            total = np.sum(exp_v)
-        else:
-            total = np.sum(exp_v, axis=1)
-        # time.sleep(1)
-        return (exp_v.T / total).T + 1e-8
+    def softmax(v, out=None):
+        """ Softmax of a vector or of every row of a matrix, into out if
+        given (which may be v itself). The maximum is subtracted before
+        exponentiating, so that large inputs do not overflow. """
+
+        out = np.subtract(v, np.max(v, axis=-1, keepdims=True), out=out)
+        np.exp(out, out=out)
+        out /= np.sum(out, axis=-1, keepdims=True)
+        return out
+
+    @staticmethod
+    def relative_change(old, new):
+        """ Change from old to new relative to old. """
+
+        return abs(new - old) / max(abs(old), np.finfo(float).tiny)
 
     @staticmethod
     def error_fraction(correct_data, data_length):
@@ -92,13 +90,35 @@ class CrossEntropyCost:
     @staticmethod
     def fn(a, y):
         """ Computes the scalar cost related to activation a and
-        actual label y. """
+        actual label y (one-hot). A probability of the label that
+        underflowed to zero counts as the smallest positive one. """
 
-        return np.mean(np.max(np.nan_to_num(-y*np.log(a)), axis=1))
+        p = np.einsum('ij,ij->i', a, y)
+        np.maximum(p, np.finfo(p.dtype).tiny, out=p)
+        return -np.mean(np.log(p))
 
     @staticmethod
-    def delta(a, y):
+    def delta(a, y, out=None):
         """ Computes the cost gradient related to activation a and
-        actual label y. """
+        actual label y, into out if given. """
+
+        return np.subtract(a, y, out=out)
 
-        return a - y
\ No newline at end of file
+    @staticmethod
+    def softmax_fn_delta(z, y, out=None):
+        """ Computes both the scalar cost and the cost gradient of a
+        softmax layer from its linear activations z rather than its
+        activation, in one pass and stably: the cost through the log of
+        the softmax, log(sum(exp(z))) - z[y], which is never infinite. The
+        gradient, softmax(z) - y, goes into out if given (which may be z
+        itself). Returns both. """
+
+        z_max = np.max(z, axis=1, keepdims=True)
+        z_y = np.einsum('ij,ij->i', z, y)
+        out = np.subtract(z, z_max, out=out)
+        np.exp(out, out=out)
+        total = np.sum(out, axis=1, keepdims=True)
+        out /= total
+        out -= y
+        cost = np.mean(np.log(total[:, 0]) + z_max[:, 0] - z_y)
+        return cost, out
\ No newline at end of file